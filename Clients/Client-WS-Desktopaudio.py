@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
-import asyncio
 import websockets
+from websockets.sync.client import connect
 import sys
 import json
 import numpy as np
@@ -43,6 +43,16 @@ except ImportError:
     print("Please install pynput: pip install pynput")
     sys.exit(1)
 
+# orjson parse nhanh hơn json của stdlib, nhận thẳng bytes/str; nếu không có thì dùng json
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+import vad_kernel
+from vad_kernel import convert_and_gate, GATE_SPEECH, GATE_UNSURE
+
 
 # --- Configuration ---
 LANG_CODE = "en"
@@ -58,28 +68,50 @@ VAD_FRAME_MS = 30
 VAD_FRAME_SAMPLES = int(SAMPLE_RATE * (VAD_FRAME_MS / 1000))
 VAD_FRAME_BYTES = VAD_FRAME_SAMPLES * BYTES_PER_SAMPLE * CHANNELS
 SILENCE_FRAMES_THRESHOLD = int(500 / VAD_FRAME_MS)
-BLOCK_SIZE_SAMPLES = VAD_FRAME_SAMPLES * 4 # 120ms
-audio_queue = asyncio.Queue()
-vad = webrtcvad.Vad(VAD_AGGRESSIVENESS)
+BLOCK_SIZE_SAMPLES = VAD_FRAME_SAMPLES * 4 # 120ms, process_block xử lý đúng 4 frame/block
+BLOCK_SIZE_BYTES = VAD_FRAME_BYTES * 4
+_vad_local = threading.local() # Mỗi thread capture có một webrtcvad.Vad riêng
 speaking = False
 silence_frames_count = 0
-temp_audio_buffer = bytearray()
+block_buffer = bytearray(BLOCK_SIZE_BYTES) # Buffer int16 dùng lại cho mỗi block
+block_samples = np.frombuffer(block_buffer, dtype=DTYPE) # View int16, kernel ghi thẳng vào đây
+_block_view = memoryview(block_buffer)
+FRAME_VIEW_0 = _block_view[0 * VAD_FRAME_BYTES:1 * VAD_FRAME_BYTES]
+FRAME_VIEW_1 = _block_view[1 * VAD_FRAME_BYTES:2 * VAD_FRAME_BYTES]
+FRAME_VIEW_2 = _block_view[2 * VAD_FRAME_BYTES:3 * VAD_FRAME_BYTES]
+FRAME_VIEW_3 = _block_view[3 * VAD_FRAME_BYTES:4 * VAD_FRAME_BYTES]
 send_audio_enabled = True
-key_listener_thread = None
 key_listener = None
 TOGGLE_KEY = keyboard.Key.space
 recording_active = True
-main_loop = None
+frames_sent = 0
 
 # --- Functions ---
-def process_vad(frame_bytes, loop):
+def get_vad():
+    """Trả về webrtcvad.Vad của thread hiện tại, tạo mới ở lần gọi đầu trong thread đó."""
+    v = getattr(_vad_local, "vad", None)
+    if v is None:
+        v = webrtcvad.Vad(VAD_AGGRESSIVENESS)
+        _vad_local.vad = v
+    return v
+
+def process_vad(frame_bytes, gate=GATE_UNSURE, vad_is_speech=None):
+    """
+    Chạy VAD cho một frame, trả về True nếu frame cần được gửi lên server.
+    frame_bytes có thể là memoryview, webrtcvad đọc thẳng từ buffer nên không cần chép ra bytes.
+    """
     global speaking, silence_frames_count
 
     try:
-        if len(frame_bytes) == VAD_FRAME_BYTES:
-            is_speech = vad.is_speech(frame_bytes, SAMPLE_RATE)
+        if len(frame_bytes) != VAD_FRAME_BYTES:
+            return False
+        # Chỉ hỏi webrtcvad khi cổng năng lượng chưa chắc chắn
+        if gate == GATE_UNSURE:
+            if vad_is_speech is None:
+                vad_is_speech = get_vad().is_speech
+            is_speech = vad_is_speech(frame_bytes, SAMPLE_RATE)
         else:
-            return
+            is_speech = gate == GATE_SPEECH
 
         should_send = False
         if is_speech:
@@ -94,25 +126,47 @@ def process_vad(frame_bytes, loop):
             else:
                 should_send = True
 
-        if should_send and send_audio_enabled:
-            if loop and loop.is_running():
-                try:
-                    # Chỉ put nếu queue chưa quá đầy để tránh block thread audio quá lâu
-                    if audio_queue.qsize() < 50: # Giới hạn queue size (tùy chỉnh)
-                        asyncio.run_coroutine_threadsafe(audio_queue.put(frame_bytes), loop)
-                    # else: print("Queue full, dropping frame.")
-                except Exception as e_put:
-                    print(f"Error putting to queue: {e_put}", file=sys.stderr)
+        return should_send and send_audio_enabled
 
     except Exception as e:
         print(f"Error during VAD processing: {e}", file=sys.stderr)
+        return False
+
+
+def process_block(f32_block, send):
+    """
+    Chuyển một block đúng BLOCK_SIZE_SAMPLES sample vào block_buffer, chạy VAD cho 4 frame
+    của nó với offset cố định rồi gửi các frame cần gửi trong một message duy nhất.
+    """
+    global frames_sent
+    # Chuyển int16 (NaN/Inf được thay thế, có bão hòa) và tính cổng VAD trong một lượt
+    gates = convert_and_gate(f32_block, block_samples, VAD_FRAME_SAMPLES)
+    vad_is_speech = get_vad().is_speech # Lấy một lần cho cả block
+    send_0 = process_vad(FRAME_VIEW_0, gates[0], vad_is_speech)
+    send_1 = process_vad(FRAME_VIEW_1, gates[1], vad_is_speech)
+    send_2 = process_vad(FRAME_VIEW_2, gates[2], vad_is_speech)
+    send_3 = process_vad(FRAME_VIEW_3, gates[3], vad_is_speech)
+
+    if send_0 and send_1 and send_2 and send_3:
+        # Cả block đều cần gửi: gửi thẳng từ block_buffer, không chép
+        send(_block_view)
+        frames_sent += 4
+        return
+
+    selected = [view for view, ok in ((FRAME_VIEW_0, send_0), (FRAME_VIEW_1, send_1),
+                                      (FRAME_VIEW_2, send_2), (FRAME_VIEW_3, send_3)) if ok]
+    if selected:
+        send(b"".join(selected))
+        frames_sent += len(selected)
 
 
 # --- SỬA LẠI audio_capture_thread ---
-def audio_capture_thread(loop):
-    """Thread ghi âm audio từ loopback microphone."""
-    global recording_active, temp_audio_buffer
-    print("[Audio Thread] Started.")
+def audio_capture_thread(websocket):
+    """Thread ghi âm audio từ loopback microphone, chạy VAD và gửi audio thẳng lên WebSocket."""
+    global recording_active
+    send = websocket.send # Bind một lần, process_block gọi cho mỗi block
+    print("[Audio Thread] Started. Press SPACE to toggle sending audio.")
+    print(f"Current state: {'SENDING' if send_audio_enabled else 'PAUSED'}")
 
     try:
         print(f"[Audio Thread] Attempting to record from: {loopback_mic.name} with {CHANNELS} channel(s), SR={SAMPLE_RATE}")
@@ -135,21 +189,16 @@ def audio_capture_thread(loop):
                 else:
                     mono_data = data.flatten()
 
-                if np.isnan(mono_data).any() or np.isinf(mono_data).any():
-                    print("[Audio Thread] Warning: NaN or Inf detected in audio data, skipping block.", file=sys.stderr)
+                if mono_data.shape[0] != BLOCK_SIZE_SAMPLES:
+                    print(f"[Audio Thread] Warning: Unexpected block size {mono_data.shape[0]}, skipping block.", file=sys.stderr)
                     continue
 
+                # Chuyển đổi + xử lý VAD + gửi
+                process_block(mono_data, send)
 
-                int_data = (np.clip(mono_data, -1.0, 1.0) * 32767).astype(DTYPE)
-                byte_data = int_data.tobytes()
-
-                # Xử lý VAD
-                temp_audio_buffer.extend(byte_data)
-                while len(temp_audio_buffer) >= VAD_FRAME_BYTES:
-                    vad_frame = temp_audio_buffer[:VAD_FRAME_BYTES]
-                    process_vad(bytes(vad_frame), loop)
-                    del temp_audio_buffer[:VAD_FRAME_BYTES]
-
+    except websockets.exceptions.ConnectionClosed:
+        print("[Audio Thread] Connection closed while sending.")
+        recording_active = False
     except RuntimeError as e:
         print(f"[Audio Thread] Soundcard Runtime Error: {e}", file=sys.stderr)
         print("[Audio Thread] Check sample rate/channels support and loopback configuration.", file=sys.stderr)
@@ -158,14 +207,14 @@ def audio_capture_thread(loop):
         print(f"[Audio Thread] Unexpected Error: {e}", file=sys.stderr)
         recording_active = False
     finally:
-        print("[Audio Thread] Finished.")
+        print(f"[Audio Thread] Finished. Total chunks sent: {frames_sent}")
 
-async def receive_task(websocket):
-    print("[Receive Task] Started.")
+def receive_thread(websocket):
+    print("[Receive Thread] Started.")
     try:
-        async for message in websocket:
+        for message in websocket:
             try:
-                result = json.loads(message)
+                result = json_loads(message) # Server gửi JSON trong binary frame, parse thẳng từ bytes
                 if "partial" in result:
                     print(f"Partial: {result['partial']}{' ' * 10}\r", end='', flush=True)
                 elif "text" in result:
@@ -173,50 +222,15 @@ async def receive_task(websocket):
                     print(f"> {result['text']} <")
                 else:
                     print(f"\nServer: {result}")
-            except json.JSONDecodeError:
+            except json.JSONDecodeError: # orjson.JSONDecodeError là lớp con của lỗi này
                 print(f"\nServer (raw): {message}")
-    except websockets.exceptions.ConnectionClosedOK:
-        print("\n[Receive Task] Connection closed normally.")
+        print("\n[Receive Thread] Connection closed normally.")
     except websockets.exceptions.ConnectionClosedError as e:
-        print(f"\n[Receive Task] Connection closed with error: {e.rcvd.code} {e.rcvd.reason}")
-    except Exception as e:
-        print(f"\n[Receive Task] Error: {e}")
-    finally:
-        print("[Receive Task] Finished.")
-
-
-async def send_task(websocket):
-    global recording_active
-    print("[Send Task] Started. Press SPACE to toggle sending audio.")
-    print(f"Current state: {'SENDING' if send_audio_enabled else 'PAUSED'}")
-    items_sent = 0
-    try:
-        while True:
-            byte_data = await audio_queue.get()
-            if byte_data is None:
-                print("[Send Task] Received stop signal.")
-                audio_queue.task_done()
-                break # Kết thúc vòng lặp
-
-            if recording_active:
-                await websocket.send(byte_data)
-                items_sent += 1
-
-            else:
-                print("[Send Task] recording_active is false, discarding data from queue.")
-
-            audio_queue.task_done()
-
-    except websockets.exceptions.ConnectionClosed:
-        print("[Send Task] Connection closed while sending.")
-        recording_active = False
+        print(f"\n[Receive Thread] Connection closed with error: {e.rcvd.code if e.rcvd else 'N/A'} {e.rcvd.reason if e.rcvd else ''}")
     except Exception as e:
-        print(f"[Send Task] Error: {e}")
-        recording_active = False
+        print(f"\n[Receive Thread] Error: {e}")
     finally:
-        print(f"[Send Task] Finished. Total chunks sent: {items_sent}")
-        if websocket and not websocket.closed:
-            await websocket.close(reason="Client terminated by user.")
+        print("[Receive Thread] Finished.")
 
 def on_press(key):
     global send_audio_enabled
@@ -240,27 +254,31 @@ def stop_key_listener():
         key_listener = None
         print("Key listener stopped.")
 
-async def run_stt_client():
-    global recording_active, key_listener_thread, main_loop
-    main_loop = asyncio.get_running_loop()
-    key_listener_thread = threading.Thread(target=start_key_listener, daemon=True)
-    key_listener_thread.start()
-    capture_thread = threading.Thread(target=audio_capture_thread, args=(main_loop,), daemon=True)
-    capture_thread.start()
+def run_stt_client():
+    """
+    Client đồng bộ: thread audio gửi thẳng lên WebSocket ngay sau VAD (không qua queue/event loop),
+    một thread khác nhận kết quả.
+    """
+    global recording_active
+    vad_kernel.warmup(VAD_FRAME_SAMPLES)
+    start_key_listener() # pynput tự chạy listener trong thread riêng, start() trả về ngay
     websocket_connection = None
+    capture_thread = None
+    receiver = None
     try:
         print(f"Connecting to {SERVER_URI}...")
-        websocket_connection = await websockets.connect(SERVER_URI, ping_interval=20, ping_timeout=20)
+        websocket_connection = connect(SERVER_URI, compression=None)
         print("Connected! Capturing desktop audio. Press SPACE to pause/resume, Ctrl+C to stop.")
 
-        receiver = asyncio.create_task(receive_task(websocket_connection))
-        sender = asyncio.create_task(send_task(websocket_connection))
+        receiver = threading.Thread(target=receive_thread, args=(websocket_connection,), daemon=True)
+        receiver.start()
+        capture_thread = threading.Thread(target=audio_capture_thread, args=(websocket_connection,), daemon=True)
+        capture_thread.start()
 
-        done, pending = await asyncio.wait(
-            [receiver, sender],
-            return_when=asyncio.FIRST_COMPLETED,
-        )
-        print("One task finished, initiating shutdown...")
+        # join có timeout để Ctrl+C vẫn được xử lý ở main thread
+        while capture_thread.is_alive() and receiver.is_alive():
+            capture_thread.join(timeout=0.2)
+        print("One thread finished, initiating shutdown...")
 
     except websockets.exceptions.InvalidURI:
         print(f"Invalid WebSocket URI: {SERVER_URI}")
@@ -278,31 +296,15 @@ async def run_stt_client():
             capture_thread.join(timeout=2)
             if capture_thread.is_alive(): print("Warning: Audio capture thread did not finish promptly.")
 
-        print("Putting stop signal into audio queue...")
-        if main_loop and main_loop.is_running():
-            future = asyncio.run_coroutine_threadsafe(audio_queue.put(None), main_loop)
-            try: future.result(timeout=1)
-            except (TimeoutError, asyncio.TimeoutError): print("Warning: Timeout putting stop signal into queue.")
-            except Exception as e_put: print(f"Error putting stop signal: {e_put}")
-        else:
-            try: audio_queue.put_nowait(None)
-            except: pass
-
-        tasks = [task for task in asyncio.all_tasks(loop=main_loop) if task is not asyncio.current_task(loop=main_loop)]
-        if tasks:
-            print(f"Cancelling {len(tasks)} outstanding asyncio tasks...")
-            for task in tasks: task.cancel()
-            await asyncio.gather(*tasks, return_exceptions=True)
-            print("Asyncio tasks cancelled.")
-
-        if websocket_connection and not websocket_connection.closed:
+        if websocket_connection:
             print("Closing WebSocket connection...")
-            await websocket_connection.close()
+            websocket_connection.close(reason="Client terminated by user.")
             print("WebSocket connection closed.")
 
+        if receiver and receiver.is_alive():
+            receiver.join(timeout=1)
+
         stop_key_listener()
-        if key_listener_thread and key_listener_thread.is_alive():
-            key_listener_thread.join(timeout=1)
 
         print("Cleanup finished. Client exiting.")
 
@@ -311,8 +313,8 @@ if __name__ == "__main__":
     recording_active = True
     send_audio_enabled = True
     try:
-        asyncio.run(run_stt_client())
+        run_stt_client()
     except KeyboardInterrupt:
         print("\nExiting program.")
     except Exception as e:
-        print(f"Fatal error in main execution: {e}")
\ No newline at end of file
+        print(f"Fatal error in main execution: {e}")
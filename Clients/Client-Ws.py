@@ -5,7 +5,7 @@ import websockets
 import sys
 import json
 import numpy as np
-import threading # Thêm threading cho key listener
+import threading
 
 # --- VAD Imports ---
 try:
@@ -32,6 +32,23 @@ except ImportError:
     print("Please install sounddevice: pip install sounddevice")
     sys.exit(1)
 
+# orjson parse nhanh hơn json của stdlib, nhận thẳng bytes/str; nếu không có thì dùng json
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# uvloop (không có trên Windows) cho event loop nhanh hơn, nếu không có thì dùng loop mặc định
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
+import vad_kernel
+from vad_kernel import gate_int16, GATE_SPEECH, GATE_UNSURE
+
 
 # --- Configuration ---
 LANG_CODE = "vi"
@@ -50,35 +67,102 @@ VAD_FRAME_BYTES = VAD_FRAME_SAMPLES * BYTES_PER_SAMPLE * CHANNELS
 SILENCE_FRAMES_THRESHOLD = int(500 / VAD_FRAME_MS) # 500 ms im lặng
 
 # --- Audio Buffer & State ---
-# BLOCK_SIZE nên là bội số của VAD_FRAME_SAMPLES để xử lý dễ dàng
-BLOCK_SIZE_MS = 120 # Ví dụ: đọc 120ms mỗi lần từ sounddevice
+# BLOCK_SIZE phải đúng bằng 4 VAD frame: audio_callback xử lý 4 frame với offset cố định
+BLOCK_SIZE_MS = 120 # Đọc 120ms mỗi lần từ sounddevice
 BLOCK_SIZE_SAMPLES = int(SAMPLE_RATE * (BLOCK_SIZE_MS / 1000))
-
-audio_queue = asyncio.Queue() # Queue để gửi audio bytes đến send_task
-vad = webrtcvad.Vad(VAD_AGGRESSIVENESS)
+BLOCK_SIZE_BYTES = BLOCK_SIZE_SAMPLES * BYTES_PER_SAMPLE * CHANNELS
+assert BLOCK_SIZE_SAMPLES == VAD_FRAME_SAMPLES * 4, "BLOCK_SIZE_MS phải bằng 4 * VAD_FRAME_MS"
+
+# --- Send Batching ---
+SEND_BATCH_MAX_BYTES = 8 * 1024 # Mỗi message WebSocket chứa tối đa ~8KiB audio
+# Mỗi callback 120ms đưa vào queue tối đa 4 frame cùng lúc: gom đúng một block thành một message,
+# không chờ thêm block sau (sẽ cộng thêm độ trễ mà không gom thêm được gì)
+SEND_BATCH_MAX_FRAMES = min(SEND_BATCH_MAX_BYTES // VAD_FRAME_BYTES, BLOCK_SIZE_BYTES // VAD_FRAME_BYTES)
+
+AUDIO_QUEUE_MAXSIZE = 50 # Tối đa 50 frame (~1.5s) chờ gửi, đầy thì bỏ frame mới
+
+audio_queue = asyncio.Queue(maxsize=AUDIO_QUEUE_MAXSIZE) # Queue để gửi audio bytes đến send_task
+queue_put_nowait = audio_queue.put_nowait # Bound method, tránh tra thuộc tính mỗi frame
+loop_call_soon_threadsafe = None # call_soon_threadsafe của event loop chạy send_task, gán trong run_stt_client
+_vad_local = threading.local() # Mỗi thread capture có một webrtcvad.Vad riêng
+pending_frames = [] # Frame cần gửi của block đang xử lý, chỉ thread PortAudio dùng
 speaking = False
 silence_frames_count = 0
-temp_audio_buffer = bytearray() # Buffer để chứa dữ liệu chưa đủ 1 VAD frame
+block_buffer = bytearray(BLOCK_SIZE_BYTES) # Buffer int16 dùng lại cho mỗi callback
+block_samples = np.frombuffer(block_buffer, dtype=DTYPE) # View int16, audio_callback chép thẳng vào đây
+_block_view = memoryview(block_buffer)
+# View cố định cho 4 VAD frame trong block
+FRAME_VIEW_0 = _block_view[0 * VAD_FRAME_BYTES:1 * VAD_FRAME_BYTES]
+FRAME_VIEW_1 = _block_view[1 * VAD_FRAME_BYTES:2 * VAD_FRAME_BYTES]
+FRAME_VIEW_2 = _block_view[2 * VAD_FRAME_BYTES:3 * VAD_FRAME_BYTES]
+FRAME_VIEW_3 = _block_view[3 * VAD_FRAME_BYTES:4 * VAD_FRAME_BYTES]
 
 # --- Keybinding State ---
 send_audio_enabled = True # Bắt đầu ở trạng thái bật
-key_listener_thread = None
 key_listener = None
 TOGGLE_KEY = keyboard.Key.space # Sử dụng phím Space
 
 # --- Functions ---
 
-def process_vad(frame_bytes):
-    """Xử lý một frame audio với VAD và quyết định có gửi không."""
+def get_vad():
+    """Trả về webrtcvad.Vad của thread hiện tại, tạo mới ở lần gọi đầu trong thread đó."""
+    v = getattr(_vad_local, "vad", None)
+    if v is None:
+        v = webrtcvad.Vad(VAD_AGGRESSIVENESS)
+        _vad_local.vad = v
+    return v
+
+def _put_frames(frames):
+    """Chạy trong event loop: đưa các frame của một block vào queue, bỏ các frame còn lại nếu queue đầy."""
+    try:
+        for frame in frames:
+            queue_put_nowait(frame)
+    except asyncio.QueueFull:
+        pass
+
+def enqueue_frame(frame_bytes):
+    """
+    Gọi từ thread của PortAudio: giữ frame lại tới cuối block, flush_frames đưa cả block sang event loop.
+    Chép frame ra bytes ở đây vì block_buffer sẽ bị ghi đè ở callback sau.
+    """
+    pending_frames.append(bytes(frame_bytes))
+
+def flush_frames():
+    """
+    Gọi cuối audio_callback: asyncio.Queue không thread-safe nên chuyển việc put sang event loop,
+    một lần call_soon_threadsafe cho cả block để send_task thấy đủ các frame cùng lúc và gửi chung một message.
+    """
+    if not pending_frames:
+        return
+    frames = pending_frames.copy()
+    pending_frames.clear()
+    call_soon_threadsafe = loop_call_soon_threadsafe
+    if call_soon_threadsafe is None:
+        return
+    try:
+        call_soon_threadsafe(_put_frames, frames)
+    except RuntimeError: # Loop đã đóng
+        pass
+
+def process_vad(frame_bytes, gate=GATE_UNSURE, vad_is_speech=None):
+    """
+    Xử lý một frame audio với VAD và quyết định có gửi không.
+    frame_bytes là memoryview vào block_buffer (bị ghi đè ở block sau), chỉ chép ra bytes khi đưa vào queue.
+    """
     global speaking, silence_frames_count
     is_speech = False
     try:
         # VAD cần đúng số byte và sample rate
-        if len(frame_bytes) == VAD_FRAME_BYTES:
-            is_speech = vad.is_speech(frame_bytes, SAMPLE_RATE)
-        else:
+        if len(frame_bytes) != VAD_FRAME_BYTES:
             print(f"Warning: Incorrect frame size for VAD: {len(frame_bytes)} != {VAD_FRAME_BYTES}", file=sys.stderr)
             return # Bỏ qua frame không đúng kích thước
+        # Cổng năng lượng đã quyết định được thì không cần gọi webrtcvad
+        if gate == GATE_UNSURE:
+            if vad_is_speech is None:
+                vad_is_speech = get_vad().is_speech
+            is_speech = vad_is_speech(frame_bytes, SAMPLE_RATE)
+        else:
+            is_speech = gate == GATE_SPEECH
 
         if is_speech:
             silence_frames_count = 0
@@ -87,9 +171,7 @@ def process_vad(frame_bytes):
                 speaking = True
             # Queue audio nếu VAD nói là speech VÀ keybind đang bật
             if send_audio_enabled:
-                try:
-                    audio_queue.put_nowait(frame_bytes)
-                except asyncio.QueueFull: pass # Bỏ qua nếu queue đầy
+                enqueue_frame(frame_bytes)
         else: # Not speech
             if speaking:
                 silence_frames_count += 1
@@ -99,9 +181,7 @@ def process_vad(frame_bytes):
                 else:
                     # Vẫn đang trong ngưỡng im lặng sau khi nói -> gửi để padding
                     if send_audio_enabled:
-                        try:
-                            audio_queue.put_nowait(frame_bytes)
-                        except asyncio.QueueFull: pass # Bỏ qua nếu queue đầy
+                        enqueue_frame(frame_bytes)
 
     except Exception as e:
         print(f"Error during VAD processing: {e}", file=sys.stderr)
@@ -109,27 +189,24 @@ def process_vad(frame_bytes):
 
 def audio_callback(indata, frames, time, status):
     """Callback nhận audio từ sounddevice, chia frame cho VAD."""
-    global temp_audio_buffer
-
     if not recording_active:
         return
     if status:
         print(f"Audio Callback Status: {status}", file=sys.stderr)
+    if frames != BLOCK_SIZE_SAMPLES:
+        print(f"Warning: Unexpected block size {frames} != {BLOCK_SIZE_SAMPLES}, skipping.", file=sys.stderr)
+        return
 
     try:
-        # Chuyển float32 sang int16 bytes
-        int_data = (indata * 32767).astype(DTYPE)
-        byte_data = int_data.tobytes()
-
-        # Nối dữ liệu mới vào buffer tạm
-        temp_audio_buffer.extend(byte_data)
-
-        # Xử lý các frame VAD hoàn chỉnh trong buffer
-        while len(temp_audio_buffer) >= VAD_FRAME_BYTES:
-            vad_frame = temp_audio_buffer[:VAD_FRAME_BYTES]
-            process_vad(bytes(vad_frame)) # Gọi xử lý VAD
-            # Xóa frame đã xử lý khỏi buffer
-            del temp_audio_buffer[:VAD_FRAME_BYTES]
+        # PortAudio trả thẳng int16, chỉ cần chép vào block_buffer (indata không còn hợp lệ sau callback)
+        block_samples[:] = indata[:, 0]
+        gates = gate_int16(block_samples, VAD_FRAME_SAMPLES)
+        vad_is_speech = get_vad().is_speech # Vad riêng của thread PortAudio, lấy một lần cho cả block
+        process_vad(FRAME_VIEW_0, gates[0], vad_is_speech)
+        process_vad(FRAME_VIEW_1, gates[1], vad_is_speech)
+        process_vad(FRAME_VIEW_2, gates[2], vad_is_speech)
+        process_vad(FRAME_VIEW_3, gates[3], vad_is_speech)
+        flush_frames()
 
     except Exception as e:
         print(f"Error in audio_callback: {e}", file=sys.stderr)
@@ -141,7 +218,7 @@ async def receive_task(websocket):
     try:
         async for message in websocket:
             try:
-                result = json.loads(message)
+                result = json_loads(message) # Server gửi JSON trong binary frame, parse thẳng từ bytes
                 if "partial" in result:
                     # Thêm \r để ghi đè dòng partial trước đó
                     print(f"Partial: {result['partial']}{' ' * 10}\r", end='', flush=True)
@@ -151,7 +228,7 @@ async def receive_task(websocket):
                     print(f"Final  : {result['text']}")
                 else:
                     print(f"\nServer: {result}") # Xuống dòng cho các message khác
-            except json.JSONDecodeError:
+            except json.JSONDecodeError: # orjson.JSONDecodeError là lớp con của lỗi này
                 print(f"\nServer (raw): {message}") # Xuống dòng
     except websockets.exceptions.ConnectionClosedOK:
         print("\nReceive task: Connection closed normally.")
@@ -162,19 +239,45 @@ async def receive_task(websocket):
     finally:
         print("Receive task finished.")
 
+async def collect_batch():
+    """
+    Chờ frame đầu tiên rồi gom thêm các frame đang có sẵn trong queue (flush_frames put cả block một lần),
+    tối đa SEND_BATCH_MAX_FRAMES frame; queue hết thì gửi ngay, không chờ timer.
+    Trả về (chunks, stop), stop=True khi gặp tín hiệu dừng (None).
+    """
+    # Bind trước vòng gom để không phải tra global/thuộc tính mỗi frame
+    q_get_nowait = audio_queue.get_nowait
+    q_empty = audio_queue.empty
+    q_done = audio_queue.task_done
+    chunks = []
+    append = chunks.append
+    item = await audio_queue.get()
+    q_done()
+    while item is not None:
+        append(item)
+        if len(chunks) >= SEND_BATCH_MAX_FRAMES:
+            return chunks, False
+        if q_empty(): # Cả block được put cùng lúc, queue hết nghĩa là đã đủ block
+            return chunks, False
+        item = q_get_nowait()
+        q_done()
+    return chunks, True
+
 async def send_task(websocket):
     # (Giữ nguyên như trước)
     global recording_active
     print("Send task started. Press SPACE to toggle sending audio.")
     print(f"Current state: {'SENDING' if send_audio_enabled else 'PAUSED'}")
+    send = websocket.send # Bind một lần ngoài vòng lặp
+    join = b"".join
+    q_empty = audio_queue.empty
     try:
-        while recording_active or not audio_queue.empty(): # Xử lý hết queue ngay cả khi dừng
-            byte_data = await audio_queue.get()
-            if byte_data is None: # Tín hiệu dừng hẳn
+        while recording_active or not q_empty(): # Xử lý hết queue ngay cả khi dừng
+            chunks, stop = await collect_batch()
+            if chunks and recording_active: # Chỉ gửi nếu vẫn đang trong trạng thái chạy chính
+                await send(join(chunks)) # Các frame PCM liền nhau, server nối lại được
+            if stop: # Tín hiệu dừng hẳn
                 break
-            if recording_active: # Chỉ gửi nếu vẫn đang trong trạng thái chạy chính
-                await websocket.send(byte_data)
-            audio_queue.task_done()
     except websockets.exceptions.ConnectionClosed:
         print("Send task: Connection closed while sending.")
         recording_active = False
@@ -196,7 +299,7 @@ def on_press(key):
         print(f"Keybind: Audio sending {state}. Press SPACE to toggle.", flush=True)
 
 def start_key_listener():
-    """Khởi động key listener trong một thread riêng."""
+    """Khởi động key listener (pynput tự tạo thread riêng cho listener)."""
     global key_listener
     # Non-blocking listener
     key_listener = keyboard.Listener(on_press=on_press)
@@ -215,30 +318,33 @@ def stop_key_listener():
 
 # --- Main Function (Cập nhật) ---
 async def run_stt_client():
-    global recording_active, key_listener_thread
+    global recording_active, loop_call_soon_threadsafe
+    loop_call_soon_threadsafe = asyncio.get_running_loop().call_soon_threadsafe
 
     # Kiểm tra audio input (giữ nguyên)
     try:
-        sd.check_input_settings(samplerate=SAMPLE_RATE, channels=CHANNELS, dtype='float32')
-        print(f"Default input device supports {SAMPLE_RATE} Hz, {CHANNELS} channel(s), float32.")
+        sd.check_input_settings(samplerate=SAMPLE_RATE, channels=CHANNELS, dtype='int16')
+        print(f"Default input device supports {SAMPLE_RATE} Hz, {CHANNELS} channel(s), int16.")
     except Exception as e:
         print(f"Error checking input device settings: {e}")
         return
 
-    # Khởi động key listener trong thread riêng
-    key_listener_thread = threading.Thread(target=start_key_listener, daemon=True)
-    key_listener_thread.start()
+    vad_kernel.warmup(VAD_FRAME_SAMPLES) # Biên dịch kernel trước khi audio callback chạy
+
+    # Listener của pynput tự chạy trong thread riêng của nó, start() trả về ngay
+    start_key_listener()
 
     stream = None # Khởi tạo stream là None
     try:
         stream = sd.InputStream(samplerate=SAMPLE_RATE,
                                 blocksize=BLOCK_SIZE_SAMPLES, # Sử dụng block size mới
-                                dtype='float32',
+                                dtype='int16', # Lấy thẳng int16, không phải chuyển từ float32
                                 channels=CHANNELS,
                                 callback=audio_callback)
 
         print(f"Connecting to {SERVER_URI}...")
-        async with websockets.connect(SERVER_URI) as websocket:
+        # Frame PCM nhỏ gần như không nén được, tắt permessage-deflate để đỡ tốn CPU/bộ nhớ
+        async with websockets.connect(SERVER_URI, compression=None) as websocket:
             print("Connected! Recording active. Press SPACE to pause/resume, Ctrl+C to stop.")
             stream.start() # Bắt đầu luồng audio SAU KHI kết nối WebSocket thành công
 
@@ -261,8 +367,16 @@ async def run_stt_client():
                 print("Audio stream stopped.")
             stream = None # Reset stream
 
-            await audio_queue.put(None) # Báo hiệu send_task dừng
-            await sender # Chờ send_task xử lý xong queue
+            if not sender.done():
+                # Không await put(): queue có giới hạn, nếu đầy thì chờ mãi. Đầy thì dừng send_task luôn
+                try:
+                    audio_queue.put_nowait(None) # Báo hiệu send_task dừng
+                except asyncio.QueueFull:
+                    sender.cancel()
+            try:
+                await sender # Chờ send_task xử lý xong queue
+            except asyncio.CancelledError:
+                print("Sender task cancelled.")
 
             if not receiver.done():
                 receiver.cancel()
@@ -293,8 +407,6 @@ async def run_stt_client():
 
         # Dừng key listener
         stop_key_listener()
-        if key_listener_thread and key_listener_thread.is_alive():
-            key_listener_thread.join(timeout=1) # Đợi thread key listener kết thúc
 
         # Gửi tín hiệu dừng cuối cùng (phòng trường hợp chưa gửi)
         if not audio_queue.empty():
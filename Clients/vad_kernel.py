@@ -0,0 +1,173 @@
+"""
+Kernel chuyển float32 -> int16 kèm cổng VAD năng lượng (energy + zero-crossing rate).
+Với thiết bị trả thẳng int16 thì dùng gate_int16, chỉ tính cổng VAD.
+
+Mỗi block audio chỉ được duyệt một lần: vừa ghi sample int16 (có bão hòa), vừa tính
+năng lượng và ZCR cho từng VAD frame. Frame chắc chắn là im lặng/giọng nói được quyết định
+ngay tại đây, chỉ các frame nằm sát ngưỡng mới cần hỏi lại webrtcvad.
+
+Dùng Numba nếu có cài (pip install numba), nếu không sẽ dùng bản NumPy tương đương.
+"""
+import threading
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+GATE_SILENCE = 0
+GATE_SPEECH = 1
+GATE_UNSURE = 2 # Sát ngưỡng, để webrtcvad quyết định
+
+ENERGY_THRESHOLD_DB = -40.0 # Ngưỡng năng lượng (dBFS) phân biệt im lặng / có tiếng
+ENERGY_MARGIN_DB = 3.0 # Trong khoảng ±3 dB quanh ngưỡng thì coi là chưa chắc chắn
+ZCR_MAX = 0.35 # ZCR cao hơn mức này (nhiễu, âm xát) thì cũng để webrtcvad quyết định
+
+
+_scratch_local = threading.local() # Buffer tạm của bản NumPy, mỗi thread capture một buffer riêng
+
+
+def _convert_and_gate_py(f32_block, out_i16, frame_samples, threshold_db, margin_db, zcr_max):
+    n = f32_block.shape[0]
+    scratch = getattr(_scratch_local, "f32", None)
+    if scratch is None or scratch.shape[0] < n:
+        scratch = np.empty(n, dtype=np.float32)
+        _scratch_local.f32 = scratch
+    clean = scratch[:n]
+    # clip đưa ±Inf về ±1 nhưng giữ NaN, nan_to_num tại chỗ thay NaN bằng 0; không cấp phát mảng mới
+    np.clip(f32_block, -1.0, 1.0, out=clean)
+    np.nan_to_num(clean, copy=False, nan=0.0)
+
+    # Tính năng lượng/ZCR trên view của clean (chưa nhân 32767) nên không cần chia lại
+    n_frames = n // frame_samples
+    frames = clean[:n_frames * frame_samples].reshape(n_frames, frame_samples)
+    energy_db = 10.0 * np.log10(np.einsum("ij,ij->i", frames, frames) / frame_samples + 1e-12)
+    signs = np.signbit(frames)
+    zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / frame_samples
+
+    np.multiply(clean, 32767.0, out=clean)
+    np.rint(clean, out=clean)
+    out_i16[:n] = clean
+
+    gate = np.full(n_frames, GATE_UNSURE, dtype=np.uint8)
+    gate[energy_db < threshold_db - margin_db] = GATE_SILENCE
+    gate[(energy_db >= threshold_db + margin_db) & (zcr <= zcr_max)] = GATE_SPEECH
+    return gate
+
+
+def _gate_int16_py(i16_block, frame_samples, threshold_db, margin_db, zcr_max):
+    n_frames = i16_block.shape[0] // frame_samples
+    frames = i16_block[:n_frames * frame_samples].reshape(n_frames, frame_samples).astype(np.float32)
+    frames *= 1.0 / 32767.0
+    energy_db = 10.0 * np.log10(np.einsum("ij,ij->i", frames, frames) / frame_samples + 1e-12)
+    signs = np.signbit(frames)
+    zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / frame_samples
+
+    gate = np.full(n_frames, GATE_UNSURE, dtype=np.uint8)
+    gate[energy_db < threshold_db - margin_db] = GATE_SILENCE
+    gate[(energy_db >= threshold_db + margin_db) & (zcr <= zcr_max)] = GATE_SPEECH
+    return gate
+
+
+if njit is not None:
+    # Không bật nnan/ninf để vẫn bắt được NaN/Inf từ driver
+    @njit(cache=True, fastmath={"nsz", "arcp", "contract", "afn", "reassoc"})
+    def _convert_and_gate_jit(f32_block, out_i16, frame_samples, threshold_db, margin_db, zcr_max):
+        n = f32_block.shape[0]
+        n_frames = n // frame_samples
+        gate = np.empty(n_frames, dtype=np.uint8)
+
+        for fi in range(n_frames):
+            energy = 0.0
+            crossings = 0
+            prev_negative = False
+            for i in range(fi * frame_samples, (fi + 1) * frame_samples):
+                v = f32_block[i]
+                # Không rẽ nhánh: LLVM sinh được lệnh min/max SIMD
+                v = v if v == v else np.float32(0.0)
+                v = min(max(v, np.float32(-1.0)), np.float32(1.0))
+                out_i16[i] = np.int16(np.rint(v * 32767.0))
+                energy += v * v
+                negative = v < 0.0
+                if i > fi * frame_samples and negative != prev_negative:
+                    crossings += 1
+                prev_negative = negative
+
+            energy_db = 10.0 * np.log10(energy / frame_samples + 1e-12)
+            zcr = crossings / frame_samples
+            if energy_db < threshold_db - margin_db:
+                gate[fi] = GATE_SILENCE
+            elif energy_db >= threshold_db + margin_db and zcr <= zcr_max:
+                gate[fi] = GATE_SPEECH
+            else:
+                gate[fi] = GATE_UNSURE
+
+        # Phần đuôi không đủ 1 frame: chỉ chuyển đổi
+        for i in range(n_frames * frame_samples, n):
+            v = f32_block[i]
+            v = v if v == v else np.float32(0.0)
+            v = min(max(v, np.float32(-1.0)), np.float32(1.0))
+            out_i16[i] = np.int16(np.rint(v * 32767.0))
+
+        return gate
+
+
+    @njit(cache=True, fastmath={"nsz", "arcp", "contract", "afn", "reassoc"})
+    def _gate_int16_jit(i16_block, frame_samples, threshold_db, margin_db, zcr_max):
+        n_frames = i16_block.shape[0] // frame_samples
+        gate = np.empty(n_frames, dtype=np.uint8)
+
+        for fi in range(n_frames):
+            energy = 0.0
+            crossings = 0
+            prev_negative = False
+            for i in range(fi * frame_samples, (fi + 1) * frame_samples):
+                s = i16_block[i]
+                energy += float(s) * float(s)
+                negative = s < 0
+                if i > fi * frame_samples and negative != prev_negative:
+                    crossings += 1
+                prev_negative = negative
+
+            energy_db = 10.0 * np.log10(energy / (frame_samples * 32767.0 * 32767.0) + 1e-12)
+            zcr = crossings / frame_samples
+            if energy_db < threshold_db - margin_db:
+                gate[fi] = GATE_SILENCE
+            elif energy_db >= threshold_db + margin_db and zcr <= zcr_max:
+                gate[fi] = GATE_SPEECH
+            else:
+                gate[fi] = GATE_UNSURE
+
+        return gate
+
+
+def convert_and_gate(f32_block, out_i16, frame_samples,
+                     threshold_db=ENERGY_THRESHOLD_DB, margin_db=ENERGY_MARGIN_DB, zcr_max=ZCR_MAX):
+    """
+    Ghi f32_block (float trong [-1, 1]) vào out_i16 dưới dạng int16 và trả về mảng uint8
+    với một giá trị GATE_* cho mỗi VAD frame hoàn chỉnh trong block.
+    """
+    if njit is not None:
+        return _convert_and_gate_jit(f32_block, out_i16, frame_samples, threshold_db, margin_db, zcr_max)
+    return _convert_and_gate_py(f32_block, out_i16, frame_samples, threshold_db, margin_db, zcr_max)
+
+
+def gate_int16(i16_block, frame_samples,
+               threshold_db=ENERGY_THRESHOLD_DB, margin_db=ENERGY_MARGIN_DB, zcr_max=ZCR_MAX):
+    """
+    Như convert_and_gate nhưng cho audio đã là int16 (thiết bị trả thẳng int16): chỉ tính cổng VAD,
+    không cần chuyển đổi. Trả về mảng uint8 với một giá trị GATE_* cho mỗi VAD frame hoàn chỉnh.
+    """
+    if njit is not None:
+        return _gate_int16_jit(i16_block, frame_samples, threshold_db, margin_db, zcr_max)
+    return _gate_int16_py(i16_block, frame_samples, threshold_db, margin_db, zcr_max)
+
+
+def warmup(frame_samples):
+    """Biên dịch trước kernel (lần gọi đầu của Numba mất khoảng 1s) để thread audio không bị trễ."""
+    block = np.zeros((frame_samples, 1), dtype=np.float32)[:, 0]
+    out = np.zeros(frame_samples, dtype=np.int16)
+    convert_and_gate(block, out, frame_samples)
+    gate_int16(out, frame_samples)
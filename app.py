@@ -1,14 +1,11 @@
-from main import create_api_info_panel
 import uvicorn
 import os
-from rich.console import Console
 
 SERVER_HOST = os.getenv("HOST", "0.0.0.0")
 SERVER_PORT = int(os.getenv("PORT", 8000))
-console = Console(stderr=True)
 
-console.print(create_api_info_panel(), style="bold")
-console.print("[bold]--- Server Logs Start Below ---[/]", style="dim")
+# Panel thông tin API được in trong lifespan của main.py, sau khi quét xong model
+# Không cần chỉ định loop: mặc định của uvicorn đã tự dùng uvloop nếu đã cài (có trong requirements.txt, trừ Windows)
 
 uvicorn.run(
     "main:app",
@@ -18,4 +15,5 @@ uvicorn.run(
     access_log=False,
     ws_ping_interval=25,
     ws_ping_timeout=20,
+    ws_per_message_deflate=False, # Audio PCM không nén được, deflate chỉ tốn CPU/bộ nhớ mỗi kết nối
 )
\ No newline at end of file
@@ -1,190 +1,249 @@
-import asyncio
 import json
 import os
-import sys
 import logging
-from vosk import Model
+import mmap
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from pathlib import Path
+from typing import Callable
+from vosk import Model, SetLogLevel
 from model_downloader import download_all_models
 
-class redirect_c_streams:
-    """
-    A context manager for temporarily redirecting C-level stdout and stderr
-    by manipulating file descriptors. Useful for silencing C libraries.
-    """
-    def __init__(self, stdout_to=os.devnull, stderr_to=os.devnull):
-        """
-        Args:
-            stdout_to (str): Path to redirect stdout to (default: os.devnull).
-            stderr_to (str): Path to redirect stderr to (default: os.devnull).
-        """
-        self._stdout_to_path = stdout_to
-        self._stderr_to_path = stderr_to
-
-        self._stdout_to_f = None
-        self._stderr_to_f = None
-
-        self._orig_stdout_fd = None
-        self._orig_stderr_fd = None
-
-        self._target_stdout_fd = None
-        self._target_stderr_fd = None
-
-    def __enter__(self):
-        sys.stdout.flush()
-        sys.stderr.flush()
-
-        self._orig_stdout_fd = os.dup(1)
-        self._orig_stderr_fd = os.dup(2)
-
-        try:
-            self._stdout_to_f = open(self._stdout_to_path, 'wb')
-            self._stderr_to_f = open(self._stderr_to_path, 'wb')
-
-            self._target_stdout_fd = self._stdout_to_f.fileno()
-            self._target_stderr_fd = self._stderr_to_f.fileno()
-
-            os.dup2(self._target_stdout_fd, 1)
-            os.dup2(self._target_stderr_fd, 2)
-        except Exception as e:
-            if self._orig_stdout_fd is not None: os.dup2(self._orig_stdout_fd, 1)
-            if self._orig_stderr_fd is not None: os.dup2(self._orig_stderr_fd, 2)
-            if self._stdout_to_f: self._stdout_to_f.close()
-            if self._stderr_to_f: self._stderr_to_f.close()
-
-            if self._orig_stdout_fd is not None: os.close(self._orig_stdout_fd)
-            if self._orig_stderr_fd is not None: os.close(self._orig_stderr_fd)
-            raise OSError(f"Failed to redirect C streams: {e}") from e
-
-        return self
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        try:
-            os.fsync(1)
-        except OSError: pass
-        try:
-            os.fsync(2)
-        except OSError: pass
-
-        try:
-            if self._orig_stdout_fd is not None:
-                os.dup2(self._orig_stdout_fd, 1)
-            if self._orig_stderr_fd is not None:
-                os.dup2(self._orig_stderr_fd, 2)
-        except OSError as e:
-            logging.error(f"!!! Critical: Failed to restore original stdout/stderr: {e}", exc_info=True)
-
-        finally:
-            if self._orig_stdout_fd is not None:
-                try:
-                    os.close(self._orig_stdout_fd)
-                except OSError as e:
-
-                    logging.warning(f"Could not close saved original stdout fd ({self._orig_stdout_fd}): {e}")
-            if self._orig_stderr_fd is not None:
-                try:
-                    os.close(self._orig_stderr_fd)
-                except OSError as e:
-                    logging.warning(f"Could not close saved original stderr fd ({self._orig_stderr_fd}): {e}")
-
-            if self._stdout_to_f:
-                try:
-                    self._stdout_to_f.close()
-                except OSError as e:
-                    logging.warning(f"Could not close target stdout file ({self._stdout_to_path}): {e}")
-            if self._stderr_to_f:
-                try:
-                    self._stderr_to_f.close()
-                except OSError as e:
-                    logging.warning(f"Could not close target stderr file ({self._stderr_to_path}): {e}")
-
-        return False
+# orjson parse nhanh hơn json của stdlib, nếu không có thì dùng json
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
-PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJECT_ROOT = str(Path(__file__).resolve().parent.parent)
 MODELS_BASE_DIR = os.path.join(PROJECT_ROOT, "Models")
+LANGUAGE_MAP_PATH = os.path.join(PROJECT_ROOT, "MODEL_LOADER.json")
 
 
-with open(os.path.join(PROJECT_ROOT, "MODEL_LOADER.json"), "r", encoding="utf-8") as f:
+@cache
+def _load_map(path: str, mtime: float) -> dict:
+    # Key có mtime: file không đổi thì dùng lại kết quả, sửa file thì lần gọi sau đọc lại
     try:
-        LANGUAGE_FOLDER_MAP = json.load(f)
-    except json.JSONDecodeError as e:
+        return json_loads(Path(path).read_bytes())
+    except json.JSONDecodeError as e: # orjson.JSONDecodeError là lớp con của lỗi này
         print(f"Error loading JSON file: {e}")
-        LANGUAGE_FOLDER_MAP = {}
+        return {}
+
+
+def load_language_folder_map() -> dict:
+    """Trả về map {tên thư mục model: lang_code} từ MODEL_LOADER.json."""
+    return _load_map(LANGUAGE_MAP_PATH, os.stat(LANGUAGE_MAP_PATH).st_mtime)
+
+
+LANGUAGE_FOLDER_MAP = load_language_folder_map()
 
 
 logger = logging.getLogger(__name__)
 
-class ModelLoader:
-    def __init__(self):
-        self.models = {}
+SetLogLevel(-1) # Tắt log của Kaldi ngay trong thư viện, không cần redirect stdout/stderr khi load model
 
-    @staticmethod
-    def check_models_folder():
-        possible_folders = os.listdir(MODELS_BASE_DIR)
-        logger.info("Đang kiểm tra các model...")
-        if len(possible_folders) == 0:
-            logger.warning("Adu, ko có model nào hết, tải...")
-            asyncio.run(download_all_models())
+WARM_STAMP_FILE = ".vosk_cache_stamp" # Ghi lại lần warm gần nhất để restart nhanh khỏi warm lại
 
-    def load_vosk_models(self) -> dict:
-        """
-        Quét thư mục MODELS_BASE_DIR, tải các model Vosk hợp lệ
-        và trả về một dictionary {lang_code: vosk.Model}.
-        """
 
-        os.makedirs("Models", exist_ok=True)
+def _warm_stamp(abs_model_path: str) -> str:
+    # mtime của thư mục am + thời điểm boot (tính theo phút): reboot hoặc model đổi thì page cache không còn đúng.
+    # Không dùng mtime của thư mục model vì chính file stamp nằm trong đó.
+    boot_minute = int((time.time() - time.monotonic()) // 60)
+    return f"{os.stat(os.path.join(abs_model_path, 'am')).st_mtime} {boot_minute}"
 
-        self.check_models_folder()
 
+# Linux: MAP_POPULATE ép nạp cả file trong một syscall; nơi khác dùng madvise + chạm từng trang
+_MAP_POPULATE = getattr(mmap, "MAP_POPULATE", 0)
 
-        loaded_models = {}
-        logger.info(f"Scanning for models in: {MODELS_BASE_DIR}")
 
-        if not os.path.isdir(MODELS_BASE_DIR):
-            logger.error(f"Models directory not found at: {MODELS_BASE_DIR}. Cannot load any models.")
-            return loaded_models
+def _prefetch_model_files(abs_model_path: str) -> None:
+    """
+    Đưa trước các file của model (final.mdl, HCLG.fst, ...) vào page cache để Model() không phải
+    chờ đọc đĩa: mmap từng file với MAP_POPULATE, hoặc madvise(WILLNEED) rồi chạm một byte mỗi trang.
+    Bỏ qua nếu model đã được warm từ lần chạy trước trong cùng phiên boot.
+    """
+    stamp_path = os.path.join(abs_model_path, WARM_STAMP_FILE)
+    stamp = None # Không tính được stamp (vd. thiếu am/) thì vẫn prefetch, chỉ không ghi file stamp
+    try:
+        stamp = _warm_stamp(abs_model_path)
+        with open(stamp_path, "r", encoding="utf-8") as f:
+            if f.read() == stamp:
+                return
+    except OSError:
+        pass
+
+    for root, _, files in os.walk(abs_model_path):
+        for name in files:
+            if name == WARM_STAMP_FILE:
+                continue
+            try:
+                with open(os.path.join(root, name), "rb") as f:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        continue
+                    if _MAP_POPULATE:
+                        # Kernel nạp toàn bộ trang ngay trong lời gọi mmap, không cần chạm từng trang
+                        mmap.mmap(f.fileno(), 0, flags=mmap.MAP_SHARED | _MAP_POPULATE, prot=mmap.PROT_READ).close()
+                        continue
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        if hasattr(mm, "madvise"):
+                            mm.madvise(mmap.MADV_WILLNEED)
+                        for offset in range(0, len(mm), mmap.PAGESIZE):
+                            mm[offset]
+            except (OSError, ValueError):
+                continue
+
+    if stamp is None:
+        return
+    try:
+        with open(stamp_path, "w", encoding="utf-8") as f:
+            f.write(stamp)
+    except OSError:
+        pass
 
-        possible_folders = os.listdir(MODELS_BASE_DIR)
 
-        for folder_name in possible_folders:
-            model_folder_path = os.path.join(MODELS_BASE_DIR, folder_name)
+class ModelLoader:
+    def __init__(self):
+        self.models = {}
+        self._paths: dict[str, str] = {} # {lang_code: đường dẫn model}, để load lười khi cần
+        self._load_locks: dict[str, threading.Lock] = {}
+        self._load_locks_guard = threading.Lock()
+        self._warm_started: set[str] = set() # Ngôn ngữ đã được đưa vào warmup, không submit lại
 
-            if os.path.isdir(model_folder_path) and folder_name in LANGUAGE_FOLDER_MAP:
-                lang_code = LANGUAGE_FOLDER_MAP[folder_name]
-                abs_model_path = os.path.abspath(model_folder_path)
+    @staticmethod
+    def check_models_folder() -> list[os.DirEntry]:
+        """
+        Tạo thư mục Models nếu chưa có, trả về các DirEntry bên trong để dùng lại khi quét.
+        Danh sách rỗng nghĩa là chưa có model nào và cần tải về.
+        """
+        os.makedirs(MODELS_BASE_DIR, exist_ok=True)
+        with os.scandir(MODELS_BASE_DIR) as it:
+            # Chỉ giữ thư mục, file lẻ (vd. *.manifest của downloader) không tính là model
+            entries = [entry for entry in it if entry.is_dir()]
+        logger.info("Đang kiểm tra các model...")
+        if not entries:
+            logger.warning("Adu, ko có model nào hết, tải...")
+        return entries
 
-                if not os.path.exists(os.path.join(abs_model_path, 'am')):
-                    logger.warning(f"Skipping folder '{folder_name}' - does not seem to contain Vosk model structure or mapping error, please check MODEL_MAPPER.json for sure.")
+    async def ensure_models(self, on_ready: Callable | None = None) -> list[os.DirEntry]:
+        """
+        Tải model về (trong event loop hiện tại) nếu thư mục Models chưa có model nào, trả về các DirEntry.
+        on_ready được gọi với ModelResult của từng model ngay khi nó tải xong.
+        """
+        entries = self.check_models_folder()
+        if not entries:
+            await download_all_models(on_ready)
+            entries = self.check_models_folder()
+        return entries
+
+    def _register_downloaded(self, result) -> str | None:
+        """Ghi lại đường dẫn của model vừa tải xong (ModelResult) để get_model load được ngay, trả về lang_code."""
+        lang_code = load_language_folder_map().get(result.path.name)
+        if lang_code is None:
+            logger.warning("Downloaded model '%s' is not in LANGUAGE_FOLDER_MAP, it will not be loaded.", result.path.name)
+            return None
+        self._paths[lang_code] = os.path.abspath(result.path)
+        return lang_code
+
+    def _scan_model_folders(self, entries: list[os.DirEntry]) -> list:
+        """
+        Trả về [(lang_code, folder_name, abs_model_path)] cho các thư mục model hợp lệ trong entries
+        (lấy từ check_models_folder) và ghi lại đường dẫn vào self._paths, không load model nào.
+        """
+        logger.info("Scanning for models in: %s", MODELS_BASE_DIR)
+        # DirEntry có sẵn loại file (d_type), không tốn thêm stat cho mỗi thư mục
+        folders = [entry for entry in entries if entry.is_dir()]
+
+        language_folder_map = load_language_folder_map()
+        to_load = [] # (lang_code, folder_name, abs_model_path)
+        for entry in folders:
+            folder_name = entry.name
+
+            if folder_name in language_folder_map:
+                lang_code = language_folder_map[folder_name]
+                abs_model_path = os.path.abspath(entry.path)
+
+                with os.scandir(abs_model_path) as sub_it:
+                    am_present = any(sub.name == 'am' for sub in sub_it)
+                if not am_present:
+                    logger.warning("Skipping folder '%s' - does not seem to contain Vosk model structure or mapping error, please check MODEL_MAPPER.json for sure.", folder_name)
                     continue
 
-                try:
-                    logger.debug(f"Attempting to load model for lang='{lang_code}' (folder: {folder_name}) from '{abs_model_path}'...")
+                logger.debug("Found model for lang='%s' (folder: %s) at '%s'.", lang_code, folder_name, abs_model_path)
+                to_load.append((lang_code, folder_name, abs_model_path))
 
-                    with redirect_c_streams():
-                        model = Model(abs_model_path)
+            else:
+                logger.warning("Skipping folder '%s' - not found in LANGUAGE_FOLDER_MAP.", folder_name)
 
-                    loaded_models[lang_code] = model
-                    logger.info(f"[✅] Successfully loaded model for '{lang_code}'.") # Dùng markup
+        self._paths = {lang_code: abs_model_path for lang_code, _, abs_model_path in to_load}
+        return to_load
 
-                except Exception as e:
-                    logger.error(f"[❌] Failed to load Vosk model for lang='{lang_code}' from {abs_model_path}: {e}", exc_info=False) # Giảm traceback nếu muốn
-
-            elif os.path.isdir(model_folder_path):
-                logger.warning(f"Skipping folder '{folder_name}' - not found in LANGUAGE_FOLDER_MAP.")
+    async def scan_models(self, preload: Callable[[str], bool] | None = None) -> list:
+        """
+        Quét thư mục Models (tải về nếu chưa có model nào). Ngôn ngữ có preload(lang_code) đúng được load trước
+        ở nền: model tải về được load ngay khi nó tải xong, trong lúc các model khác vẫn đang tải;
+        model có sẵn thì load sau khi quét. Các model khác load ở lần get_model đầu tiên.
+        Trả về danh sách mã ngôn ngữ có sẵn.
+        """
+        def on_ready(result):
+            lang_code = self._register_downloaded(result)
+            if lang_code is not None and preload is not None and preload(lang_code):
+                self.warmup([lang_code])
 
-        if not loaded_models:
-            logger.warning("Warning: No Vosk models were loaded successfully!")
-        else:
-            logger.info(f"Finished loading models. Supported languages: {list(loaded_models.keys())}")
+        self._scan_model_folders(await self.ensure_models(on_ready))
+        logger.info("Found models for languages: %s", list(self._paths.keys()))
+        if preload is not None:
+            self.warmup([lang_code for lang_code in self._paths if preload(lang_code)])
+        return self.available_languages()
 
-        self.models = loaded_models
+    def available_languages(self) -> list:
+        """Các ngôn ngữ có model, gồm cả model chưa được load."""
+        return list(self._paths.keys() | self.models.keys())
 
-        return self.models
+    def _lock_for(self, lang_code: str) -> threading.Lock:
+        with self._load_locks_guard:
+            return self._load_locks.setdefault(lang_code, threading.Lock())
 
     def get_model(self, lang_code) -> Model | None:
         """
-        Trả về model Vosk cho mã ngôn ngữ đã cho.
+        Trả về model Vosk cho mã ngôn ngữ đã cho, load ở lần gọi đầu tiên rồi giữ lại cho cả phiên.
+        Hàm có thể chặn lâu (load model), gọi từ async thì dùng asyncio.to_thread.
         """
-        return self.models.get(lang_code)
+        model = self.models.get(lang_code)
+        if model is not None:
+            return model
+
+        abs_model_path = self._paths.get(lang_code)
+        if abs_model_path is None:
+            return None
+
+        with self._lock_for(lang_code): # Nhiều request cùng ngôn ngữ chỉ load một lần
+            model = self.models.get(lang_code)
+            if model is None:
+                logger.info("Loading model for '%s' on first use...", lang_code)
+                try:
+                    # Đọc trước file model vào page cache bằng một mmap(MAP_POPULATE) mỗi file, Model() không phải chờ đĩa
+                    _prefetch_model_files(abs_model_path)
+                    model = Model(abs_model_path)
+                except Exception as e:
+                    logger.error("[❌] Failed to load Vosk model for lang='%s' from %s: %s", lang_code, abs_model_path, e, exc_info=False)
+                    return None
+                self.models[lang_code] = model
+                logger.info("[✅] Successfully loaded model for '%s'.", lang_code)
+        return model
+
+    def warmup(self, langs: list) -> None:
+        """Load trước các ngôn ngữ trong langs ở thread nền, không chặn caller. Ngôn ngữ đã warmup rồi thì bỏ qua."""
+        langs = [lang_code for lang_code in langs if lang_code in self._paths and lang_code not in self._warm_started]
+        if not langs:
+            return
+        self._warm_started.update(langs)
+        executor = ThreadPoolExecutor(max_workers=min(len(langs), os.cpu_count() or 1), thread_name_prefix="model-warmup")
+        for lang_code in langs:
+            executor.submit(self.get_model, lang_code)
+        executor.shutdown(wait=False)
 
     def get_all(self):
         return self.models
\ No newline at end of file
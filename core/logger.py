@@ -1,33 +1,16 @@
 #########################################################
 # Author: Yuuki (@yuuki.dn)
-# Chỉ cần import vào thôi, code nó tự chạy <(")
+# Gọi setup_logger() ở entrypoint để cấu hình, import không làm gì cả
+# (đặt AUTO_LOG_CONFIG=1 để import tự cấu hình như trước)
 #########################################################
 import logging
+import time
 from logging import Filter, INFO, Formatter, StreamHandler, WARNING, ERROR, FileHandler, basicConfig
-from os import makedirs
+from os import makedirs, environ
 from sys import stdout, stderr
 
 from colorama import Fore, Style, init
 
-# Create file .logs/client.log if not exist
-try:
-    open(".logs/client.log", "a").close()
-except FileNotFoundError:
-    makedirs(".logs", exist_ok=True)
-    open(".logs/client.log", "w").close()
-
-# Setup logging
-init(autoreset=True)
-
-class SpectificLevelFilter(Filter):
-    ## Logging filter that allow only the spectified level to be processed
-    def __init__(self, level: int):
-        super().__init__()
-        self.level = level
-
-    def filter(self, record) -> bool:
-        return record.levelno == self.level
-
 class VoskIgnoreFilter(Filter):
     def filter(self, record) -> bool:
         return not record.name.startswith("vosk")
@@ -37,37 +20,98 @@ INFO_FORMAT = f"{Style.DIM}[%(asctime)s]{Style.RESET_ALL} [%(name)s:%(lineno)d]
 WARNING_FORMAT = f"{Style.DIM}[%(asctime)s]{Style.RESET_ALL} [%(name)s:%(lineno)d] [⚠️]  {Fore.YELLOW}[%(levelname)s] - %(message)s{Style.RESET_ALL}"
 ERROR_FORMAT = f"{Style.DIM}[%(asctime)s]{Style.RESET_ALL} [%(name)s:%(lineno)d] [❌] {Fore.RED}[%(levelname)s] - %(message)s{Style.RESET_ALL}"
 
-DATEFMT="%d-%m-%Y %H:%M:%S"
-
-## Create handlers
-infoHandler = StreamHandler(stream=stdout)
-infoHandler.setLevel(INFO)
-infoHandler.addFilter(SpectificLevelFilter(INFO))
-infoHandler.setFormatter(Formatter(INFO_FORMAT, datefmt=DATEFMT))
-
-warningHandler = StreamHandler(stream=stdout)
-warningHandler.setLevel(WARNING)
-warningHandler.addFilter(SpectificLevelFilter(WARNING))
-warningHandler.setFormatter(Formatter(WARNING_FORMAT, datefmt=DATEFMT))
-
-errorHandler = StreamHandler(stream=stderr)
-errorHandler.setLevel(ERROR)
-errorHandler.addFilter(SpectificLevelFilter(ERROR))
-errorHandler.setFormatter(Formatter(ERROR_FORMAT, datefmt=DATEFMT))
-
-fileHandler = FileHandler(".logs/client.log", mode="a", encoding="utf-8")
-fileHandler.setLevel(INFO)
-fileHandler.setFormatter(Formatter("%(asctime)s %(name)s:%(lineno)d [%(levelname)s] - %(message)s", datefmt=DATEFMT))
-
-## Configure
-basicConfig(
-    level=INFO,
-    handlers=[infoHandler, warningHandler, errorHandler, fileHandler]
-)
-
-___log = logging.getLogger(__name__)
-___log.addFilter(VoskIgnoreFilter())
+## Format không màu, dùng khi output không phải terminal (pipe, file, service log)
+INFO_PLAIN_FORMAT = "[%(asctime)s] [%(name)s:%(lineno)d] [✅] [%(levelname)s] - %(message)s"
+WARNING_PLAIN_FORMAT = "[%(asctime)s] [%(name)s:%(lineno)d] [⚠️]  [%(levelname)s] - %(message)s"
+ERROR_PLAIN_FORMAT = "[%(asctime)s] [%(name)s:%(lineno)d] [❌] [%(levelname)s] - %(message)s"
 
+DATEFMT="%d-%m-%Y %H:%M:%S"
 
-def setup_loger(): # Ignore optimize import by pycharm
-    pass
\ No newline at end of file
+class CachedTimeFormatter(Formatter):
+    ## Cache chuỗi thời gian theo từng giây, DATEFMT không có phần nhỏ hơn giây nên
+    ## các record trong cùng một giây dùng lại kết quả strftime.
+    ## Giữ (giây, chuỗi) trong một tuple để các thread không đọc được cặp lệch nhau.
+    def __init__(self, fmt=None, datefmt=DATEFMT):
+        super().__init__(fmt, datefmt=datefmt)
+        self._last = (None, "")
+
+    def formatTime(self, record, datefmt=None) -> str:
+        if datefmt is None:
+            return super().formatTime(record, datefmt)
+        ct = int(record.created)
+        last_ct, last_s = self._last
+        if ct == last_ct:
+            return last_s
+        s = time.strftime(datefmt, self.converter(ct))
+        self._last = (ct, s)
+        return s
+
+class ColorFormatter(Formatter):
+    ## Chọn format theo level, chỉ thêm mã màu colorama khi stream là terminal.
+    ## Formatter cho từng level được tạo sẵn một lần.
+    COLOR_FORMATS = {INFO: INFO_FORMAT, WARNING: WARNING_FORMAT, ERROR: ERROR_FORMAT}
+    PLAIN_FORMATS = {INFO: INFO_PLAIN_FORMAT, WARNING: WARNING_PLAIN_FORMAT, ERROR: ERROR_PLAIN_FORMAT}
+
+    def __init__(self, stream=stdout, datefmt=DATEFMT):
+        super().__init__(datefmt=datefmt)
+        isatty = getattr(stream, "isatty", None)
+        formats = self.COLOR_FORMATS if isatty is not None and isatty() else self.PLAIN_FORMATS
+        self._formatters = {level: CachedTimeFormatter(fmt, datefmt=datefmt) for level, fmt in formats.items()}
+
+    def format(self, record) -> str:
+        if record.levelno >= ERROR:
+            return self._formatters[ERROR].format(record)
+        if record.levelno >= WARNING:
+            return self._formatters[WARNING].format(record)
+        return self._formatters[INFO].format(record)
+
+class ConsoleHandler(StreamHandler):
+    ## Một handler cho console: ERROR trở lên ra stderr, còn lại ra stdout.
+    ## emit được gọi trong lock của handler nên đổi self.stream ở đây là an toàn.
+    def __init__(self):
+        super().__init__(stream=stdout)
+
+    def emit(self, record):
+        self.stream = stderr if record.levelno >= ERROR else stdout
+        super().emit(record)
+
+_configured = False
+
+def setup_logger():
+    ## Tạo file log, init colorama và gắn handler. Gọi nhiều lần cũng chỉ cấu hình một lần.
+    global _configured
+    if _configured:
+        return
+    _configured = True
+
+    # Create file .logs/client.log if not exist
+    try:
+        open(".logs/client.log", "a").close()
+    except FileNotFoundError:
+        makedirs(".logs", exist_ok=True)
+        open(".logs/client.log", "w").close()
+
+    init(autoreset=True)
+
+    ## Create handlers
+    consoleHandler = ConsoleHandler()
+    consoleHandler.setLevel(INFO)
+    consoleHandler.setFormatter(ColorFormatter(stdout))
+
+    fileHandler = FileHandler(".logs/client.log", mode="a", encoding="utf-8")
+    fileHandler.setLevel(INFO)
+    fileHandler.setFormatter(CachedTimeFormatter("%(asctime)s %(name)s:%(lineno)d [%(levelname)s] - %(message)s", datefmt=DATEFMT))
+
+    ## Configure
+    basicConfig(
+        level=INFO,
+        handlers=[consoleHandler, fileHandler]
+    )
+
+    logging.getLogger(__name__).addFilter(VoskIgnoreFilter())
+
+setup_loger = setup_logger # Tên cũ
+
+# Import không tạo file/handler; AUTO_LOG_CONFIG=1 bật lại hành vi cũ cho code chỉ import module này
+if environ.get("AUTO_LOG_CONFIG", "0") == "1":
+    setup_logger()
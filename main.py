@@ -1,20 +1,34 @@
 import asyncio
-import json
 import logging
 import os
+import queue
 import random
+import socket
 import sys
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Path, UploadFile, File, HTTPException
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import cache
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Path, UploadFile, File, HTTPException, Query, Request
 from websockets.exceptions import ConnectionClosedOK, ConnectionClosedError
-import core.logger # noqa
+from core.logger import setup_logger
 from vosk import KaldiRecognizer
-import io
-from pydub import AudioSegment
+import wave
+from typing import BinaryIO
+try:
+    import av # Decode audio ngay trong process, không phải spawn ffmpeg
+except ImportError:
+    av = None
+    from pydub import AudioSegment
 from core.loader import ModelLoader
 from rich.console import Console
 from rich.panel import Panel
 from rich.logging import RichHandler
 from rich.text import Text
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -27,6 +41,20 @@ MAX_UPLOAD_SIZE_BYTES = int(os.getenv("MAX_UPLOAD_SIZE_BYTES", 100 * 1024 * 1024
 SAMPLE_RATE = 16000.0
 SERVER_HOST = os.getenv("HOST", "0.0.0.0")
 SERVER_PORT = int(os.getenv("PORT", 8000))
+# Ngôn ngữ load trước ở nền khi khởi động: "*" = tất cả, "" = chỉ load khi có request, hoặc "en,vi"
+PRELOAD_MODELS = os.getenv("PRELOAD_MODELS", "*")
+# Pool cho các việc chặn CPU của endpoint HTTP (decode audio, nhận dạng)
+EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count())
+MULTIPART_OVERHEAD_BYTES = 64 * 1024 # Dư cho header/boundary multipart khi so Content-Length với giới hạn
+FILE_TOO_LARGE_MESSAGES = ("File size exceeds the maximum limit.", "Please don't eat my family.", "This file is too big.")
+# Số KaldiRecognizer giữ lại để dùng lại cho mỗi ngôn ngữ, tạo mới tốn vài chục MB và vài chục ms
+RECOGNIZER_POOL_SIZE = int(os.getenv("RECOGNIZER_POOL_SIZE", 4))
+RECOGNIZER_POOL: dict[str, queue.LifoQueue] = defaultdict(queue.LifoQueue) # LIFO: recognizer vừa trả còn nóng trong cache
+# Partial rỗng trong JSON Vosk trả về ({"partial" : ""}), không cần gửi cho client
+EMPTY_PARTIAL = b'"partial" : ""'
+EMPTY_TEXT = b'"text" : ""'
+
+setup_logger()
 
 console = Console(stderr=True)
 logging.basicConfig(
@@ -45,30 +73,90 @@ logging.basicConfig(
 logging.getLogger("vosk").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
-logger.info("Initializing model loader...")
-
 model_loader = ModelLoader()
-loaded_models =  model_loader.load_vosk_models()
-
-if not loaded_models:
-    logger.error("FATAL: No Vosk models were loaded successfully by the loader. Exiting.")
-    sys.exit(1)
+# Điền một lần trong lifespan (frozenset để kiểm tra lang_code O(1) ở mỗi request), model được load lười ở lần dùng đầu
+available_languages: frozenset[str] = frozenset()
+
+def should_preload(lang_code: str) -> bool:
+    """True nếu lang_code nằm trong PRELOAD_MODELS."""
+    preload = PRELOAD_MODELS.strip()
+    return preload == "*" or lang_code in (lang.strip() for lang in preload.split(","))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Quét/tải model ngay trong event loop của server thay vì asyncio.run ở lúc import
+    global available_languages
+    logger.info("Initializing model loader...")
+    # Model tải về lúc khởi động được load ngay khi tải xong, không chờ các model còn đang tải
+    available_languages = frozenset(await model_loader.scan_models(should_preload))
+
+    if not available_languages:
+        logger.error("FATAL: No Vosk models were found by the loader. Exiting.")
+        raise RuntimeError("No Vosk models available")
+
+    console.print(create_api_info_panel(), style="bold")
+    console.print("[bold]--- Server Logs Start Below ---[/]", style="dim")
+    yield
 
 app = FastAPI(
     title="Vosk Streaming STT API (Loaded via Module)",
     description="Real-time Speech-to-Text API using Vosk and FastAPI WebSockets. Models loaded from external module.",
     version="1.2.0",
     docs_url=None,
-    redoc_url=None
+    redoc_url=None,
+    lifespan=lifespan
 )
 
-def convert_audio_for_vosk(audio_bytes: bytes, target_sr: int = 16000, target_channels: int = 1) -> bytes | None:
+def _pcm_from_wav(audio_file: BinaryIO, target_sr: int, target_channels: int) -> bytes | None:
+    """
+    Nếu audio đã là WAV PCM 16-bit đúng sample rate/số kênh thì chỉ cần bỏ header, không cần decode.
+    Trả về None (và đưa audio_file về đầu file) nếu không phải trường hợp đó.
+    """
+    header = audio_file.read(12)
+    audio_file.seek(0)
+    if header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        return None
+    try:
+        with wave.open(audio_file, "rb") as wav: # File do caller mở, wave không đóng nó
+            if wav.getframerate() == target_sr and wav.getnchannels() == target_channels and wav.getsampwidth() == 2:
+                return wav.readframes(wav.getnframes())
+    except (wave.Error, EOFError):
+        pass
+    audio_file.seek(0)
+    return None
+
+def convert_audio_for_vosk(audio_file: BinaryIO, target_sr: int = 16000, target_channels: int = 1) -> bytes | None:
     """
-    Chuyển đổi audio (từ bytes) sang định dạng PCM 16-bit, mono, 16kHz mà Vosk yêu cầu.
+    Chuyển đổi audio (từ một file nhị phân đã mở, đọc từ đầu) sang định dạng PCM 16-bit, mono, 16kHz mà Vosk yêu cầu.
+    Decode ngay trong process bằng PyAV, chỉ dùng pydub (gọi ffmpeg) khi chưa cài av.
     Trả về bytes của audio đã chuyển đổi, hoặc None nếu lỗi.
     """
+    pcm_data = _pcm_from_wav(audio_file, target_sr, target_channels)
+    if pcm_data is not None:
+        logger.debug("Input is already PCM S16LE WAV, skipped decoding")
+        return pcm_data
+
+    if av is not None:
+        try:
+            bytes_per_sample = 2 * target_channels
+            resampler = av.AudioResampler(format="s16", layout="mono" if target_channels == 1 else "stereo", rate=target_sr)
+            chunks = []
+            with av.open(audio_file) as container:
+                for frame in container.decode(audio=0):
+                    for out in resampler.resample(frame):
+                        # Buffer của plane có thể dài hơn dữ liệu thật do căn lề, chỉ lấy đúng số mẫu
+                        chunks.append(memoryview(out.planes[0])[:out.samples * bytes_per_sample])
+                for out in resampler.resample(None):
+                    chunks.append(memoryview(out.planes[0])[:out.samples * bytes_per_sample])
+            pcm_data = b"".join(chunks)
+            logger.debug(f"Decoded to raw PCM S16LE with PyAV, size: {len(pcm_data)} bytes")
+            return pcm_data
+        except Exception as e:
+            logger.error(f"Audio conversion failed using PyAV: {e}", exc_info=True)
+            return None
+
     try:
-        audio = AudioSegment.from_file(io.BytesIO(audio_bytes))
+        audio = AudioSegment.from_file(audio_file)
 
         if audio.frame_rate != target_sr:
             audio = audio.set_frame_rate(target_sr)
@@ -86,23 +174,81 @@ def convert_audio_for_vosk(audio_bytes: bytes, target_sr: int = 16000, target_ch
         logger.error(f"Audio conversion failed using pydub: {e}", exc_info=True)
         return None
 
+def acquire_recognizer(lang_code: str, model) -> KaldiRecognizer:
+    """Lấy một KaldiRecognizer đã dùng xong trong pool (đã Reset), hoặc tạo mới nếu pool trống."""
+    try:
+        recognizer = RECOGNIZER_POOL[lang_code].get_nowait()
+        recognizer.Reset()
+        return recognizer
+    except queue.Empty:
+        return KaldiRecognizer(model, SAMPLE_RATE)
+
+def release_recognizer(lang_code: str, recognizer: KaldiRecognizer) -> None:
+    """Trả recognizer về pool để dùng lại, bỏ đi nếu pool đã đủ RECOGNIZER_POOL_SIZE."""
+    pool = RECOGNIZER_POOL[lang_code]
+    if pool.qsize() < RECOGNIZER_POOL_SIZE:
+        pool.put_nowait(recognizer)
+
+def is_raw_pcm_content_type(content_type: str | None) -> bool:
+    """
+    True nếu Content-Type khai báo sẵn PCM 16-bit đúng định dạng Vosk cần,
+    vd "audio/l16; rate=16000; channels=1" (rate/channels bỏ trống thì coi như 16kHz mono).
+    """
+    if not content_type:
+        return False
+    mime, *params = [part.strip() for part in content_type.lower().split(";")]
+    if mime != "audio/l16":
+        return False
+    options = dict(param.split("=", 1) for param in params if "=" in param)
+    return options.get("rate", str(int(SAMPLE_RATE))) == str(int(SAMPLE_RATE)) and options.get("channels", "1") == "1"
+
+def _do_stt(lang_code: str, model, audio_file: BinaryIO, raw_pcm: bool = False) -> str | None:
+    """
+    Chuyển audio sang PCM rồi nhận dạng, chạy trong EXECUTOR.
+    audio_file là file upload (SpooledTemporaryFile của Starlette), đọc thẳng từ đó, không copy cả file vào RAM trước.
+    raw_pcm=True nghĩa là audio đã là PCM S16LE 16kHz mono, đưa thẳng vào recognizer.
+    Trả về text nhận dạng được, hoặc None nếu không chuyển đổi được audio.
+    """
+    if raw_pcm:
+        pcm_audio_bytes = audio_file.read() # Một lần đọc ra bytes, binding cffi (char *) chỉ nhận bytes
+    else:
+        pcm_audio_bytes = convert_audio_for_vosk(audio_file, target_sr=int(SAMPLE_RATE))
+        if pcm_audio_bytes is None:
+            return None
+        logger.debug(f"Audio converted to {len(pcm_audio_bytes)} bytes of raw PCM data.")
+
+    recognizer = acquire_recognizer(lang_code, model)
+    try:
+        recognizer.SetWords(False)
+        recognizer.AcceptWaveform(pcm_audio_bytes)
+        return json_loads(recognizer.FinalResult()).get('text', '')
+    finally:
+        release_recognizer(lang_code, recognizer)
+
+@cache
+def _display_host() -> str:
+    """
+    Địa chỉ hiển thị trên panel. Khi bind 0.0.0.0 thì dò IP LAN bằng một socket UDP (không gửi gì),
+    chỉ dò một lần rồi cache lại.
+    """
+    if SERVER_HOST != "0.0.0.0":
+        return SERVER_HOST
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("8.8.8.8", 80))
+            return s.getsockname()[0]
+    except Exception:
+        return "localhost"
+
 def create_api_info_panel() -> Panel:
     """Tạo Panel hiển thị thông tin API."""
     info_text = Text()
     info_text.append("🚀 Vosk Streaming STT Server is Running!\n\n", style="bold bright_green")
     info_text.append("WebSocket Endpoint:\n", style="bold white")
 
-    display_host = SERVER_HOST
-    if display_host == "0.0.0.0":
-        try:
-            import socket
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            display_host = s.getsockname()[0]
-            s.close()
-        except Exception:
-            display_host = "localhost"
-            info_text.append(f"(Accessible via localhost and potentially other IPs)\n", style="dim white")
+    display_host = _display_host()
+    if SERVER_HOST == "0.0.0.0" and display_host == "localhost":
+        info_text.append("(Accessible via localhost and potentially other IPs)\n", style="dim white")
 
     base_url = f"http://{display_host}:{SERVER_PORT}"
     ws_base_url = f"ws://{display_host}:{SERVER_PORT}/ws/stt/"
@@ -113,7 +259,7 @@ def create_api_info_panel() -> Panel:
     info_text.append(f"  {ws_base_url}", style="cyan")
     info_text.append("{lang_code}\n", style="cyan dim")
     info_text.append("\nSupported Languages (codes):\n", style="bold white")
-    lang_list = ", ".join(sorted([f"{lang}" for lang in loaded_models.keys()]))
+    lang_list = ", ".join(sorted(available_languages))
     info_text.append(f"  {lang_list}\n")
 
     return Panel(
@@ -123,6 +269,25 @@ def create_api_info_panel() -> Panel:
         padding=(1, 2)
     )
 
+async def websocket_writer(websocket: WebSocket, out_queue: asyncio.Queue):
+    """
+    Gửi kết quả trong out_queue theo thứ tự. Mỗi lần lấy hết những gì đang chờ:
+    kết quả cuối luôn được gửi, partial chỉ gửi nếu chưa bị message sau nó thay thế.
+    """
+    try:
+        while True:
+            batch = [await out_queue.get()]
+            while not out_queue.empty():
+                batch.append(out_queue.get_nowait())
+            last = len(batch) - 1
+            for i, (is_final, result_json) in enumerate(batch):
+                if is_final or i == last:
+                    await websocket.send_bytes(result_json)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.debug(f"WebSocket writer stopped: {e}")
+
 @app.websocket("/ws/stt/{lang_code}")
 async def websocket_endpoint(
         websocket: WebSocket,
@@ -132,63 +297,75 @@ async def websocket_endpoint(
     client_port = websocket.client.port
     RECEIVE_TIMEOUT = 0.35
 
-    if lang_code not in model_loader.get_all():
+    if lang_code not in available_languages:
         logger.warning(f"Unsupported language '{lang_code}' requested by {client_host}:{client_port}. Closing connection.")
         await websocket.close(code=1008, reason=f"Unsupported language: {lang_code}")
         return
 
-    model = model_loader.get_model(lang_code)
-    logger.info(f"✅ Connection accepted: Language [{lang_code}] from {client_host}:{client_port}")
+    # Accept trước: load model lần đầu có thể lâu hơn open_timeout của client, không giữ handshake trong lúc đó
     await websocket.accept()
+    logger.info(f"✅ Connection accepted: Language [{lang_code}] from {client_host}:{client_port}")
 
-    logger.debug(f"Initializing KaldiRecognizer for lang='{lang_code}'...")
-    recognizer = KaldiRecognizer(model, SAMPLE_RATE)
-    recognizer.SetWords(True)
-    logger.debug(f"KaldiRecognizer initialized successfully.")
+    model = await asyncio.to_thread(model_loader.get_model, lang_code) # Có thể phải load model lần đầu
+    if model is None:
+        logger.error(f"Could not load model for '{lang_code}', closing connection from {client_host}:{client_port}.")
+        await websocket.close(code=1011, reason=f"Could not load model for: {lang_code}")
+        return
+
+    logger.debug(f"Acquiring KaldiRecognizer for lang='{lang_code}'...")
+    recognizer = acquire_recognizer(lang_code, model)
+    recognizer.SetWords(False) # Client chỉ dùng "text", tắt word timing để Result() gửi thẳng được
+    logger.debug("KaldiRecognizer ready.")
+
+    last_partial_json = b""
+    loop = asyncio.get_running_loop()
+    flush_handle: asyncio.TimerHandle | None = None
+    # Vòng nhận chỉ đẩy (is_final, json) vào hàng đợi, task writer gửi đi để send chậm không chặn việc nhận dạng
+    out_queue: asyncio.Queue[tuple[bool, bytes]] = asyncio.Queue()
+    writer_task = asyncio.create_task(websocket_writer(websocket, out_queue))
+
+    def flush_final():
+        # Gọi khi client im lặng RECEIVE_TIMEOUT giây: chốt câu hiện tại và gửi kết quả cuối
+        nonlocal last_partial_json
+        last_partial_json = b""
+        result_json = recognizer.FinalResultBytes()
+        if EMPTY_TEXT not in result_json:
+            out_queue.put_nowait((True, result_json))
 
     try:
         logger.debug("Entering main processing loop...")
         while True:
-            try:
-                data = await asyncio.wait_for(
-                    websocket.receive_bytes(),
-                    timeout=RECEIVE_TIMEOUT
-                )
-                logger.debug(f"Received {len(data)} bytes.")
-                processed = recognizer.AcceptWaveform(data)
-
-                partial_result_json = recognizer.PartialResult()
-                partial_result_dict = json.loads(partial_result_json)
-                partial_text = partial_result_dict.get('partial', '')
-
-                if partial_text:
-                    await websocket.send_text(json.dumps({"partial": partial_text}))
-
-                if processed:
-                    result_json = recognizer.Result()
-                    result_dict = json.loads(result_json)
-                    final_text = result_dict.get('text', '')
-                    if final_text:
-                        await websocket.send_text(json.dumps({"text": final_text}))
-                else:
-                    partial_result_json = recognizer.PartialResult()
-                    partial_result_dict = json.loads(partial_result_json)
-                    partial_text = partial_result_dict.get('partial', '')
-                    if partial_text:
-                        await websocket.send_text(json.dumps({"partial": partial_text}))
-            except asyncio.TimeoutError:
-                final_result_json = recognizer.FinalResult()
-                final_result_dict = json.loads(final_result_json)
-                final_text = final_result_dict.get('text', '')
-                if final_text:
-                    await websocket.send_text(json.dumps({"text": final_text}))
-
+            data = await websocket.receive_bytes()
+            if writer_task.done():
+                # Writer đã dừng (gửi lỗi): không còn ai đọc out_queue, dừng luôn thay vì để queue phình ra
+                logger.warning(f"WebSocket writer stopped for {client_host}:{client_port}, closing connection.")
+                try:
+                    await websocket.close(code=1011, reason="Result writer stopped")
+                except Exception:
+                    pass # Writer thường dừng vì kết nối đã hỏng, close cũng có thể lỗi
+                break
+            # Có audio mới thì hoãn lần chốt câu, hẹn lại sau khi xử lý xong frame này
+            if flush_handle is not None:
+                flush_handle.cancel()
+            logger.debug(f"Received {len(data)} bytes.")
+            # Một lần gọi: nhận audio và lấy luôn JSON kết quả dạng bytes UTF-8, gửi nguyên văn không decode/encode
+            processed, result_json = recognizer.AcceptWaveformBytes(data)
+
+            if processed:
+                # Result() đã là JSON {"text": ...} (SetWords tắt)
+                last_partial_json = b""
+                if EMPTY_TEXT not in result_json:
+                    out_queue.put_nowait((True, result_json))
+            else:
+                # PartialResult đã là JSON đúng schema {"partial": ...}, chỉ gửi khi nó thay đổi
+                if result_json != last_partial_json and EMPTY_PARTIAL not in result_json:
+                    last_partial_json = result_json
+                    out_queue.put_nowait((False, result_json))
+            flush_handle = loop.call_later(RECEIVE_TIMEOUT, flush_final)
 
     except WebSocketDisconnect as e:
         logger.warning(f"🛑 WebSocket disconnected: lang='{lang_code}' from {client_host}:{client_port}. Code: {e.code}, Reason: {e.reason or 'N/A'}")
-        final_result_json = recognizer.FinalResult()
-        final_result_dict = json.loads(final_result_json)
-        final_text = final_result_dict.get('text', '')
+        final_text = json_loads(recognizer.FinalResult()).get('text', '')
         if final_text:
             logger.info(f"🔊 ({lang_code}) Final (on disconnect) from {client_host}:{client_port}: \"{final_text}\"")
 
@@ -199,10 +376,14 @@ async def websocket_endpoint(
     except Exception as e:
         logger.error(f"💥 Unhandled exception during WebSocket comm for lang='{lang_code}' ({client_host}:{client_port}): {e}", exc_info=True)
         try:
-            await websocket.close(code=1011, reason=f"Internal server error")
+            await websocket.close(code=1011, reason="Internal server error")
         except Exception:
             pass
     finally:
+        if flush_handle is not None:
+            flush_handle.cancel()
+        writer_task.cancel()
+        release_recognizer(lang_code, recognizer)
         logger.debug(f"Cleaned up resources for connection {client_host}:{client_port}")
 
 @app.post(
@@ -211,26 +392,36 @@ async def websocket_endpoint(
     response_description="The recognized text",
 )
 async def http_stt_endpoint(
+        request: Request,
         lang_code: str = Path(..., title="Language code", min_length=1, max_length=10),
-        file: UploadFile = File(..., description="Audio file to be transcribed (e.g., WAV, MP3, OGG)")
+        file: UploadFile = File(..., description="Audio file to be transcribed (e.g., WAV, MP3, OGG)"),
+        raw: bool = Query(False, description="The file is already raw PCM S16LE, 16kHz, mono (same as Content-Type audio/l16)")
 ):
     """
     Nhận dạng giọng nói từ một file âm thanh được tải lên.
 
     - **lang_code**: Mã ngôn ngữ (vd: 'vn', 'en').
-    - **file**: File âm thanh cần nhận dạng. Hệ thống sẽ cố gắng chuyển đổi định dạng nếu cần (yêu cầu `pydub` và `ffmpeg`).
+    - **file**: File âm thanh cần nhận dạng. Hệ thống sẽ cố gắng chuyển đổi định dạng nếu cần (dùng `av`, hoặc `pydub` và `ffmpeg` nếu chưa cài `av`).
+    - **raw**: Đặt `true` nếu file đã là PCM S16LE 16kHz mono (hoặc gửi với Content-Type `audio/l16; rate=16000`), bỏ qua bước chuyển đổi.
     """
 
     logger.info(f"Received HTTP STT request for lang='{lang_code}' from file '{file.filename}' ({file.content_type})")
 
     try:
-        file.file.seek(0, os.SEEK_END)
-        file_size = file.file.tell()
-        await file.seek(0)
+        # Content-Length của cả body multipart luôn >= kích thước file, vượt giới hạn thì chắc chắn quá lớn
+        content_length = request.headers.get("content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > MAX_UPLOAD_SIZE_BYTES + MULTIPART_OVERHEAD_BYTES:
+            file_size = int(content_length)
+        else:
+            file_size = file.size # Starlette đã đếm khi nhận file, không cần seek
+        if file_size is None:
+            file.file.seek(0, os.SEEK_END)
+            file_size = file.file.tell()
+            await file.seek(0)
         if file_size > MAX_UPLOAD_SIZE_BYTES:
             logger.debug(f"File name {file.filename} with size {file_size} bytes exceeds limit of {MAX_UPLOAD_SIZE_BYTES} bytes.")
             await file.close()
-            raise HTTPException(status_code=413, detail=random.choice(["File size exceeds the maximum limit.", "Please don't eat my family.", "This file is too big."]))
+            raise HTTPException(status_code=413, detail=random.choice(FILE_TOO_LARGE_MESSAGES))
 
         if file_size == 0:
             logger.debug(f"Received empty file: '{file.filename}'")
@@ -244,48 +435,37 @@ async def http_stt_endpoint(
         await file.close()
         raise HTTPException(status_code=500, detail="Error processing file size.")
 
-    if lang_code not in model_loader.get_all():
+    if lang_code not in available_languages:
         logger.warning(f"Unsupported language '{lang_code}' requested for file '{file.filename}'.")
+        await file.close()
         raise HTTPException(status_code=400, detail=f"Unsupported language: {lang_code}")
 
-    model = model_loader.get_model(lang_code)
-
-    try:
-        audio_bytes = await file.read()
-        if not audio_bytes:
-            logger.warning(f"Received empty file: '{file.filename}'")
-            raise HTTPException(status_code=400, detail="Empty audio file received.")
-
-        logger.debug(f"Read {len(audio_bytes)} bytes from '{file.filename}'. Attempting conversion if needed...")
-        pcm_audio_bytes = convert_audio_for_vosk(audio_bytes, target_sr=int(SAMPLE_RATE))
-
-        if pcm_audio_bytes is None:
-            logger.error(f"Failed to convert audio file '{file.filename}' to required PCM format.")
-            raise HTTPException(status_code=400, detail="Could not process audio file. Ensure it's a valid audio format.")
-
-        logger.debug(f"Audio converted to {len(pcm_audio_bytes)} bytes of raw PCM data.")
-
-    except Exception as e:
-        logger.error(f"Error reading or processing uploaded file '{file.filename}': {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Error processing audio file: {e}")
-    finally:
+    model = await asyncio.to_thread(model_loader.get_model, lang_code) # Có thể phải load model lần đầu
+    if model is None:
+        await file.close()
+        raise HTTPException(status_code=503, detail=f"Could not load model for: {lang_code}")
 
+    raw_pcm = raw or is_raw_pcm_content_type(file.content_type)
+    if raw_pcm and file_size % 2:
+        logger.warning(f"Raw PCM upload '{file.filename}' has an odd length ({file_size} bytes).")
         await file.close()
+        raise HTTPException(status_code=400, detail="Raw PCM S16LE audio must have an even number of bytes.")
 
     try:
-        recognizer = KaldiRecognizer(model, SAMPLE_RATE)
-        # recognizer.SetWords(True)
-        logger.debug(f"KaldiRecognizer initialized successfully.")
-        recognizer.AcceptWaveform(pcm_audio_bytes)
-        result_json = recognizer.FinalResult()
-        result_dict = json.loads(result_json)
-        final_text = result_dict.get('text', '')
-        logger.debug(f"🔊 ({lang_code}) HTTP Final from file '{file.filename}': \"{final_text}\"")
-        return {"text": final_text}
-
+        await file.seek(0)
+        # Decode + nhận dạng chặn CPU lâu, chạy trong EXECUTOR để không chặn event loop (các phiên WebSocket khác).
+        # Đưa thẳng file.file (đã nằm trong RAM/đĩa tạm của Starlette) cho decoder, không đọc ra thêm một bản copy.
+        final_text = await asyncio.get_running_loop().run_in_executor(EXECUTOR, _do_stt, lang_code, model, file.file, raw_pcm)
     except Exception as e:
         logger.error(f"💥 Unhandled exception during HTTP STT recognition for lang='[bold cyan]{lang_code}[/]' (file: {file.filename}):", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Internal server error during recognition: {type(e).__name__}")
     finally:
+        await file.close()
         logger.debug(f"Cleaned up resources for HTTP STT request (file: {file.filename})")
 
+    if final_text is None:
+        logger.error(f"Failed to convert audio file '{file.filename}' to required PCM format.")
+        raise HTTPException(status_code=400, detail="Could not process audio file. Ensure it's a valid audio format.")
+
+    logger.debug(f"🔊 ({lang_code}) HTTP Final from file '{file.filename}': \"{final_text}\"")
+    return {"text": final_text}
@@ -1,32 +1,79 @@
+import os
+import sys
 import time
 import aiohttp
 import zipfile
+import tarfile
+import io
 import shutil
-import json
+import struct
+import zlib
 import logging
 from pathlib import Path
 import asyncio
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial, cache
+from collections import Counter
+from typing import Callable, NamedTuple
 from tqdm.asyncio import tqdm
-import core.logger # noqa
+try:
+    from stream_unzip import stream_unzip # Giải nén trong lúc tải, không cần file zip tạm
+except ImportError:
+    stream_unzip = None
+try:
+    import zstandard # Chỉ cần khi MODELS.json trỏ tới file .tar.zst
+except ImportError:
+    zstandard = None
+try:
+    import uvloop # Chỉ dùng khi chạy file này trực tiếp, server thì uvicorn tự dùng uvloop khi đã cài
+except ImportError:
+    uvloop = None
+from core.logger import setup_logger
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 log = logging.getLogger(__name__)
 
 MODELS_DIR = Path("Models")
+DOWNLOAD_CHUNK_SIZE = 1 << 20 # 1 MiB mỗi lần đọc/ghi khi tải model
+STREAM_QUEUE_CHUNKS = 256 # Số chunk mạng tối đa chờ thread giải nén khi tải kiểu stream
+PROGRESS_UPDATE_INTERVAL = 0.2 # Giây giữa hai lần vẽ lại thanh tiến trình
+PROGRESS_UPDATE_BYTES = 64 << 20
+RANGE_DOWNLOAD_PARTS = 4 # Số kết nối Range song song cho mỗi file zip (1 = tắt)
+RANGE_MIN_SIZE = 32 << 20 # File nhỏ hơn thì tải một luồng
+MEMORY_DOWNLOAD_LIMIT = 64 << 20 # Zip nhỏ hơn thì giữ trong RAM rồi giải nén luôn, không ghi ra đĩa (0 = tắt)
+# Tổng kích thước các zip được giữ trong RAM cùng lúc, tính chung cho mọi download. Lúc nối chunk
+# mỗi zip chiếm gấp đôi, nên RAM tối đa khoảng 2 x MEMORY_DOWNLOAD_BUDGET; hết budget thì ghi ra đĩa
+MEMORY_DOWNLOAD_BUDGET = 128 << 20
+ZIP_TAIL_PROBE_SIZE = 64 << 10 # Đuôi file zip tải về để đọc central directory khi kiểm tra model đã cài
+MAX_CONCURRENT_DOWNLOADS = 4 # Số model tải cùng lúc
+# Số file zip giải nén cùng lúc. Mỗi lần giải nén đã tự chạy song song trên nhiều thread,
+# nên chỉ cần vài file một lúc để disk không bị tranh giành; các thread CPU được chia đều cho chúng
+MAX_CONCURRENT_EXTRACTIONS = 2
 MODELS_DIR.mkdir(exist_ok=True)
 
-try:
-    with open("MODELS.json", 'r') as f:
-        MODELS_LINKS = json.load(f)
-except (FileNotFoundError, json.JSONDecodeError) as e:
-    log.error(f"Error loading MODELS.json: {e}")
-    MODELS_LINKS = {}
+def _load_json(path: str) -> dict:
+    try:
+        return json_loads(Path(path).read_bytes())
+    except (FileNotFoundError, ValueError) as e: # JSONDecodeError của json/orjson đều là ValueError
+        log.error(f"Error loading {path}: {e}")
+        return {}
+
+
+# Chỉ đọc JSON khi thật sự cần tải model (lần gọi đầu), import module này không tốn gì
+@cache
+def _models_links() -> dict:
+    return _load_json("MODELS.json")
 
-try:
-    with open("MODEL_MAPPER.json", 'r') as f:
-        MODEL_TARGET_NAMES = json.load(f)
-except (FileNotFoundError, json.JSONDecodeError) as e:
-    log.error(f"Error loading MODEL_MAPPER.json: {e}")
-    MODEL_TARGET_NAMES = {}
+
+@cache
+def _model_target_names() -> dict:
+    return _load_json("MODEL_MAPPER.json")
 
 
 class ModelDownloadError(Exception):
@@ -37,58 +84,525 @@ class ModelExtractionError(Exception):
     """Custom exception for extraction errors."""
     pass
 
-async def download_file(session: aiohttp.ClientSession, url: str, destination: Path) -> None:
-    """Downloads a file from a URL to a destination path with a progress bar."""
+class ModelResult(NamedTuple):
+    """Outcome of process_model: status is "ok" (downloaded), "skipped" (already installed) or "failed"."""
+    language: str
+    status: str
+    path: Path | None = None
+    error: Exception | None = None
+
+
+class ThrottledProgress:
+    """
+    Wraps a tqdm bar and batches update() calls, pushing them to the bar at most every
+    PROGRESS_UPDATE_INTERVAL seconds (or PROGRESS_UPDATE_BYTES) instead of on every network chunk.
+    """
+
+    def __init__(self, bar: tqdm):
+        self.bar = bar
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def update(self, size: int) -> None:
+        self.pending += size
+        now = time.monotonic()
+        if self.pending >= PROGRESS_UPDATE_BYTES or now - self.last_flush > PROGRESS_UPDATE_INTERVAL:
+            self.bar.update(self.pending)
+            self.pending = 0
+            self.last_flush = now
+
+    def close(self) -> None:
+        if self.pending:
+            self.bar.update(self.pending)
+            self.pending = 0
+        self.bar.close()
+
+
+async def _range_download_size(session: aiohttp.ClientSession, url: str) -> int | None:
+    """
+    Returns the file size if the server accepts byte ranges and the file is big enough to split
+    across RANGE_DOWNLOAD_PARTS connections, otherwise None (use a single stream).
+    """
+    if RANGE_DOWNLOAD_PARTS < 2 or not hasattr(os, "pwrite"):
+        return None
+    try:
+        async with session.head(url, allow_redirects=True) as response:
+            if response.status != 200 or response.headers.get("Accept-Ranges", "").lower() != "bytes":
+                return None
+            total_size = int(response.headers.get("Content-Length", 0))
+    except (aiohttp.ClientError, ValueError):
+        return None
+    return total_size if total_size >= RANGE_MIN_SIZE else None
+
+
+async def _zip_eocd_crc(session: aiohttp.ClientSession, url: str) -> int | None:
+    """
+    Fetches only the last ZIP_TAIL_PROBE_SIZE bytes of a zip (Range: bytes=-N) and returns the CRC32 of its
+    central directory, which lists every entry's name, size and CRC and so changes whenever the archive does.
+    Returns None if the server ignores Range or the central directory does not fit in the tail.
+    """
+    try:
+        async with session.get(url, headers={"Range": f"bytes=-{ZIP_TAIL_PROBE_SIZE}"}) as response:
+            if response.status != 206:
+                return None # Server trả cả file, không đọc
+            tail = await response.read()
+    except aiohttp.ClientError as e:
+        log.debug(f"Could not probe zip tail of {url}: {e}")
+        return None
+
+    eocd = tail.rfind(zipfile.stringEndArchive)
+    if eocd < 0 or len(tail) - eocd < zipfile.sizeEndCentDir:
+        return None
+    cd_size = struct.unpack(zipfile.structEndArchive, tail[eocd:eocd + zipfile.sizeEndCentDir])[5]
+    cd_end = eocd
+    if cd_size == 0xFFFFFFFF:
+        # Zip64: kích thước thật nằm trong bản ghi zip64 end of central directory, ngay trước locator
+        cd_end = eocd - zipfile.sizeEndCentDir64Locator - zipfile.sizeEndCentDir64
+        if cd_end < 0 or tail[cd_end:cd_end + 4] != zipfile.stringEndArchive64:
+            return None
+        cd_size = struct.unpack(zipfile.structEndArchive64, tail[cd_end:cd_end + zipfile.sizeEndCentDir64])[8]
+    cd_start = cd_end - cd_size
+    if cd_start < 0:
+        return None
+    return zlib.crc32(tail[cd_start:cd_end])
+
+
+async def _download_range(session: aiohttp.ClientSession, url: str, fd: int, start: int, end: int,
+                          write_pool: ThreadPoolExecutor, progress_bar: "ThrottledProgress") -> None:
+    """Downloads bytes start..end (inclusive) of url and pwrites them at the same offsets of fd."""
+    loop = asyncio.get_running_loop()
+    async with session.get(url, headers={"Range": f"bytes={start}-{end}"}) as response:
+        if response.status != 206:
+            raise ModelDownloadError(f"Server ignored Range request (HTTP {response.status})")
+        offset = start
+        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            await loop.run_in_executor(write_pool, os.pwrite, fd, chunk, offset)
+            offset += len(chunk)
+            progress_bar.update(len(chunk))
+    if offset != end + 1:
+        raise ModelDownloadError(f"Range {start}-{end} incomplete: got {offset - start} bytes")
+
+
+def _preallocate(fd: int, size: int) -> None:
+    """Reserves size bytes for fd up front so the filesystem can allocate contiguous extents once."""
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            pass # Filesystem không hỗ trợ, ghi bình thường vẫn tự nới file
+
+
+async def _download_in_ranges(session: aiohttp.ClientSession, url: str, destination: Path, part_path: Path, total_size: int) -> None:
+    """Downloads url over RANGE_DOWNLOAD_PARTS parallel Range requests into a preallocated .part file."""
+    part_size = -(-total_size // RANGE_DOWNLOAD_PARTS)
+    ranges = [(start, min(start + part_size, total_size) - 1) for start in range(0, total_size, part_size)]
+    progress_bar = ThrottledProgress(tqdm(
+        total=total_size,
+        unit='B',
+        unit_scale=True,
+        unit_divisor=1024,
+        desc=f"Downloading {destination.name} ({len(ranges)} streams)",
+        leave=False
+    ))
+    # Pool ghi riêng để chờ được mọi pwrite xong trước khi đóng fd, kể cả khi một range lỗi
+    write_pool = ThreadPoolExecutor(max_workers=len(ranges))
+    fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        _preallocate(fd, total_size)
+        tasks = [asyncio.create_task(_download_range(session, url, fd, start, end, write_pool, progress_bar)) for start, end in ranges]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        await asyncio.to_thread(os.fsync, fd)
+    finally:
+        await asyncio.to_thread(write_pool.shutdown, True)
+        os.close(fd)
+        progress_bar.close()
+
+    os.replace(part_path, destination)
+    await asyncio.to_thread(_fsync_dir, destination.parent)
+
+
+async def download_file(session: aiohttp.ClientSession, url: str, destination: Path, in_memory_limit: int = 0,
+                        range_size: int | None = None) -> bytes | None:
+    """
+    Downloads a file from a URL to a destination path with a progress bar.
+    If the server reports a size of at most in_memory_limit bytes, nothing is written to disk:
+    the content is returned as bytes instead (destination is then only used for naming).
+    range_size is the result of _range_download_size if the caller already probed it.
+    """
     log.info(f"Attempting download: {url} -> {destination}")
+    part_path = destination.with_name(destination.name + ".part")
     progress_bar = None
     try:
+        total_size = range_size or await _range_download_size(session, url)
+        if total_size and total_size > in_memory_limit:
+            try:
+                await _download_in_ranges(session, url, destination, part_path, total_size)
+                log.info(f"Successfully downloaded: {destination}")
+                return
+            except (ModelDownloadError, aiohttp.ClientError) as e:
+                log.warning(f"Parallel range download failed for {url} ({e}), falling back to a single stream.")
+                await safe_remove_async(part_path)
+
         async with session.get(url) as response:
             response.raise_for_status()
             total_size = int(response.headers.get('content-length', 0))
 
-            progress_bar = tqdm(
+            progress_bar = ThrottledProgress(tqdm(
                 total=total_size,
                 unit='B',
                 unit_scale=True,
                 unit_divisor=1024,
                 desc=f"Downloading {destination.name}",
                 leave=False
-            )
+            ))
 
             try:
-                with open(destination, "wb") as f:
+                if 0 < total_size <= in_memory_limit:
+                    # File nhỏ: giữ nguyên các chunk trong RAM, nối một lần khi xong. Cố ý nối ra bytes (lúc nối tốn
+                    # gấp đôi): BytesIO trên bytes không copy, nên ZipFile của mọi thread giải nén dùng chung một buffer
+                    chunks = []
                     downloaded_size = 0
-                    async for chunk in response.content.iter_chunked(8192):
-                        if not chunk:
-                            break
-                        size = f.write(chunk)
-                        downloaded_size += size
-                        if progress_bar:
-                            progress_bar.update(size)
+                    async for chunk in response.content.iter_any():
+                        chunks.append(chunk)
+                        downloaded_size += len(chunk)
+                        progress_bar.update(len(chunk))
+                    if downloaded_size < total_size:
+                        raise ModelDownloadError(f"Download incomplete for {destination.name}: {downloaded_size}/{total_size} bytes.")
+                    log.info(f"Successfully downloaded {destination.name} into memory ({downloaded_size} bytes)")
+                    return b"".join(chunks)
+
+                # Ghi ra file .part, đủ dữ liệu và fsync xong mới đổi tên thành file thật
+                with open(part_path, "wb") as f:
+                    _preallocate(f.fileno(), total_size)
+                    downloaded_size = 0
+                    # Gom các chunk mạng (thường chỉ vài chục KB) vào buffer dùng lại, đầy mới ghi một lần.
+                    # Hai buffer luân phiên: một buffer đang được ghi trong thread thì vẫn nhận dữ liệu vào buffer kia,
+                    # ghi đĩa chồng lên tải mạng. Mỗi lúc chỉ có một lần ghi nên file vẫn đúng thứ tự.
+                    views = [memoryview(bytearray(DOWNLOAD_CHUNK_SIZE)) for _ in range(2)]
+                    current = 0
+                    filled = 0
+                    pending_write = None
+                    try:
+                        async for chunk in response.content.iter_any():
+                            size = len(chunk)
+                            if filled + size > DOWNLOAD_CHUNK_SIZE:
+                                if pending_write is not None:
+                                    await pending_write
+                                # Ghi đĩa trong thread để không chặn event loop (các download khác, server)
+                                pending_write = asyncio.ensure_future(asyncio.to_thread(f.write, views[current][:filled]))
+                                current ^= 1
+                                filled = 0
+                            if size >= DOWNLOAD_CHUNK_SIZE:
+                                if pending_write is not None:
+                                    await pending_write
+                                    pending_write = None
+                                await asyncio.to_thread(f.write, chunk)
+                            else:
+                                views[current][filled:filled + size] = chunk
+                                filled += size
+                            downloaded_size += size
+                            if progress_bar:
+                                progress_bar.update(size)
+                        if pending_write is not None:
+                            await pending_write
+                            pending_write = None
+                        if filled:
+                            await asyncio.to_thread(f.write, views[current][:filled])
+                    finally:
+                        if pending_write is not None:
+                            await asyncio.gather(pending_write, return_exceptions=True)
+                    f.flush()
+                    await asyncio.to_thread(os.fsync, f.fileno())
 
                 if total_size != 0 and downloaded_size < total_size:
                     raise ModelDownloadError(f"Download incomplete for {destination.name}: {downloaded_size}/{total_size} bytes.")
 
+                os.replace(part_path, destination)
+                await asyncio.to_thread(_fsync_dir, destination.parent)
+                log.info(f"Successfully downloaded: {destination}")
+
             finally:
                 if progress_bar:
                     progress_bar.close()
 
-                log.info(f"Successfully downloaded: {destination}")
-
     except aiohttp.ClientError as e:
         log.error(f"Download failed for {url}: {e}")
+        await safe_remove_async(part_path)
         if destination.exists():
-            safe_remove(destination)
+            await safe_remove_async(destination)
         raise ModelDownloadError(f"Failed to download {url}: {e}") from e
     except Exception as e:
         log.error(f"An unexpected error occurred during download of {url}: {e}")
+        await safe_remove_async(part_path)
         if destination.exists():
-            safe_remove(destination)
+            await safe_remove_async(destination)
         if progress_bar:
             progress_bar.close()
         raise ModelDownloadError(f"Unexpected error downloading {url}: {e}") from e
 
 
+_memory_in_use = 0 # Byte của MEMORY_DOWNLOAD_BUDGET đang được dùng, chỉ đổi trong event loop nên không cần lock
+
+
+def _reserve_memory(size: int | None) -> int:
+    """
+    Reserves size bytes of MEMORY_DOWNLOAD_BUDGET for keeping a zip in memory.
+    Returns the number of bytes reserved, 0 if the zip should be written to disk instead.
+    """
+    global _memory_in_use
+    if not size or size > MEMORY_DOWNLOAD_LIMIT or _memory_in_use + size > MEMORY_DOWNLOAD_BUDGET:
+        return 0
+    _memory_in_use += size
+    return size
+
+
+def _release_memory(size: int) -> None:
+    global _memory_in_use
+    _memory_in_use -= size
+
+
+_STREAM_ABORTED = object() # Đặt vào chunk queue khi tải lỗi/bị huỷ, khác None (hết file bình thường)
+
+
+def _queue_chunks(chunk_queue: queue.Queue):
+    """Yields the chunks put on chunk_queue until None; raises if the producer aborted the stream."""
+    while (chunk := chunk_queue.get()) is not None:
+        if chunk is _STREAM_ABORTED:
+            raise ModelDownloadError("Download aborted before the archive was complete")
+        yield chunk
+
+
+def _abort_stream(chunk_queue: queue.Queue) -> None:
+    """Tells the extractor thread to stop; drops pending chunks if needed so the signal always fits in the queue."""
+    while True:
+        try:
+            chunk_queue.put_nowait(_STREAM_ABORTED)
+            return
+        except queue.Full:
+            try:
+                chunk_queue.get_nowait()
+            except queue.Empty:
+                pass
+
+
+def _extract_stream(chunk_queue: queue.Queue, extract_to: Path) -> Path:
+    """
+    Runs in a worker thread: extracts the zip whose bytes arrive on chunk_queue (None ends the stream,
+    _STREAM_ABORTED fails it)
+    and returns the extracted 'vosk-model-*' directory. Removes the partial directory on failure.
+    """
+    base = extract_to.resolve()
+    root_name = None
+    try:
+        for file_name, _, unzipped_chunks in stream_unzip(_queue_chunks(chunk_queue)):
+            name = file_name.decode("utf-8")
+            target = (base / name).resolve()
+            if not target.is_relative_to(base):
+                raise ModelExtractionError(f"Unsafe path in archive: {name}")
+            parts = Path(name).parts
+            if root_name is None and parts and parts[0].startswith("vosk-model-"):
+                root_name = parts[0]
+
+            if name.endswith("/"):
+                target.mkdir(parents=True, exist_ok=True)
+                for _ in unzipped_chunks:
+                    pass
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with open(target, "wb") as f:
+                for chunk in unzipped_chunks:
+                    f.write(chunk)
+    except Exception:
+        if root_name is not None and (base / root_name).is_dir():
+            shutil.rmtree(base / root_name, ignore_errors=True)
+        raise
+    finally:
+        # Nhả producer nếu nó đang chờ queue trống chỗ
+        while not chunk_queue.empty():
+            chunk_queue.get_nowait()
+
+    if root_name is None:
+        raise ModelExtractionError("No directory starting with 'vosk-model-' found in the downloaded archive")
+    return base / root_name
+
+
+def _archive_kind(url: str) -> str:
+    """Archive type from the URL suffix: 'tar.zst', 'tar' (gz/xz/bz2/plain, auto-detected) or 'zip'."""
+    path = url.split("?", 1)[0].lower()
+    if path.endswith((".tar.zst", ".tzst")):
+        return "tar.zst"
+    if path.endswith((".tar", ".tar.gz", ".tgz", ".tar.xz", ".txz", ".tar.bz2")):
+        return "tar"
+    return "zip"
+
+
+class _QueueReader(io.RawIOBase):
+    """Read-only file object over byte chunks arriving on a queue (None marks the end)."""
+
+    def __init__(self, chunk_queue: queue.Queue):
+        self._queue = chunk_queue
+        self._chunk = memoryview(b"")
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._chunk and not self._eof:
+            chunk = self._queue.get()
+            if chunk is None:
+                self._eof = True
+            elif chunk is _STREAM_ABORTED:
+                raise ModelDownloadError("Download aborted before the archive was complete")
+            else:
+                self._chunk = memoryview(chunk)
+        size = min(len(b), len(self._chunk))
+        b[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+
+def _extract_tar_stream(chunk_queue: queue.Queue, extract_to: Path, zstd: bool = False) -> Path:
+    """
+    Runs in a worker thread: extracts a .tar.gz/.tar.xz/.tar.bz2 (or .tar.zst when zstd=True) streamed
+    through chunk_queue member by member and returns the extracted 'vosk-model-*' directory.
+    Removes the partial directory on failure.
+    """
+    base = extract_to.resolve()
+    root_name = None
+    raw = io.BufferedReader(_QueueReader(chunk_queue), buffer_size=DOWNLOAD_CHUNK_SIZE)
+    try:
+        fileobj = raw
+        if zstd:
+            fileobj = zstandard.ZstdDecompressor().stream_reader(raw)
+        with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+            for member in tar:
+                root, sep, _ = member.name.partition('/')
+                if root_name is None and root.startswith("vosk-model-") and (sep or member.isdir()):
+                    root_name = root
+                if hasattr(tarfile, "data_filter"):
+                    tar.extract(member, base, filter="data")
+                else:
+                    if not (base / member.name).resolve().is_relative_to(base) or member.issym() or member.islnk():
+                        raise ModelExtractionError(f"Unsafe member in archive: {member.name}")
+                    tar.extract(member, base)
+    except Exception:
+        if root_name is not None and (base / root_name).is_dir():
+            shutil.rmtree(base / root_name, ignore_errors=True)
+        raise
+    finally:
+        while not chunk_queue.empty():
+            chunk_queue.get_nowait()
+
+    if root_name is None:
+        raise ModelExtractionError("No directory starting with 'vosk-model-' found in the downloaded archive")
+    return base / root_name
+
+
+async def download_and_extract_stream(session: aiohttp.ClientSession, url: str, extract_to: Path, extractor=None) -> Path:
+    """
+    Downloads a model archive and extracts it while it downloads, without writing the archive to disk.
+    extractor runs in a worker thread and consumes the chunk queue; defaults to the zip extractor
+    (requires stream-unzip). Returns the extracted 'vosk-model-*' directory.
+    """
+    log.info(f"Attempting streamed download + extraction: {url} -> {extract_to}")
+    loop = asyncio.get_running_loop()
+    chunk_queue = queue.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+    extract_future = loop.run_in_executor(None, extractor or _extract_stream, chunk_queue, extract_to)
+
+    async def feed(item: bytes | None) -> bool:
+        # Đưa chunk cho thread giải nén, trả về False nếu thread đó đã dừng (lỗi) thì ngừng tải
+        if extract_future.done():
+            return False
+        try:
+            chunk_queue.put_nowait(item)
+        except queue.Full:
+            # Queue đầy: chờ chỗ trống bằng put chặn trong thread, không poll. Không treo được vì thread
+            # giải nén luôn dọn sạch queue khi dừng, kể cả khi lỗi
+            await loop.run_in_executor(None, chunk_queue.put, item)
+        return True
+
+    progress_bar = None
+    fed_all = False
+    try:
+        async with session.get(url) as response:
+            response.raise_for_status()
+            total_size = int(response.headers.get('content-length', 0))
+            progress_bar = ThrottledProgress(tqdm(
+                total=total_size,
+                unit='B',
+                unit_scale=True,
+                unit_divisor=1024,
+                desc=f"Downloading {Path(url).name}",
+                leave=False
+            ))
+            async for chunk in response.content.iter_any():
+                if not await feed(chunk):
+                    break
+                progress_bar.update(len(chunk))
+        await feed(None)
+        fed_all = True
+    except aiohttp.ClientError as e:
+        log.error(f"Download failed for {url}: {e}")
+        _abort_stream(chunk_queue)
+        fed_all = True
+        await asyncio.gather(extract_future, return_exceptions=True) # Chờ thread xoá thư mục giải nén dở
+        raise ModelDownloadError(f"Failed to download {url}: {e}") from e
+    finally:
+        if progress_bar:
+            progress_bar.close()
+        if not fed_all:
+            # Lỗi khác hoặc bị huỷ: thread giải nén không được chờ queue.get() mãi
+            _abort_stream(chunk_queue)
+
+    try:
+        extracted_path = await extract_future
+    except ModelExtractionError:
+        raise
+    except Exception as e:
+        raise ModelExtractionError(f"Failed to extract {url} while downloading: {e}") from e
+    log.info(f"Successfully downloaded and extracted: {extracted_path}")
+    return extracted_path
+
+
+def _fsync_dir(path: Path) -> None:
+    """Flushes a directory entry to disk so a rename inside it survives a crash (skipped on Windows)."""
+    if sys.platform == "win32":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_tree(path: Path) -> None:
+    """Flushes every file under path to disk."""
+    for root, _, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if sys.platform == "win32":
+                # Windows chỉ flush được qua handle mở để ghi; file chỉ đọc thì bỏ qua
+                try:
+                    with open(file_path, "rb+") as f:
+                        os.fsync(f.fileno())
+                except OSError:
+                    continue
+            else:
+                # POSIX fsync được cả fd chỉ đọc, không cần quyền ghi (member 0o444 trong tar)
+                fd = os.open(file_path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+
 def safe_remove(path: Path):
     """Safely removes a file with retries on PermissionError."""
     if not path.is_file():
@@ -108,19 +622,73 @@ def safe_remove(path: Path):
     log.error(f"Failed to remove file {path} after multiple attempts.")
 
 
-def unzip_and_find_model(zip_path: Path, extract_to: Path) -> Path:
-    """Unzips an archive and finds the 'vosk-model-*' directory."""
+async def safe_remove_async(path: Path):
+    """Like safe_remove, but for coroutines: retries with asyncio.sleep and exponential backoff (50/100/200 ms)
+    so a locked file does not block the event loop and every other download with it."""
+    if not path.is_file():
+        log.debug(f"Attempted to remove non-existent file: {path}")
+        return
+    for attempt in range(3):
+        try:
+            path.unlink()
+            log.debug(f"Removed file: {path}")
+            return
+        except PermissionError:
+            delay = 0.05 * 2 ** attempt
+            log.warning(f"PermissionError removing {path}, attempt {attempt + 1}/3. Retrying after {delay * 1000:.0f}ms...")
+            await asyncio.sleep(delay)
+        except Exception as e:
+            log.error(f"Error removing file {path}: {e}")
+            return
+    log.error(f"Failed to remove file {path} after multiple attempts.")
+
+
+def _subdir_names(path: Path) -> set[str] | None:
+    """Names of the subdirectories of path from a single scandir (d_type, no stat per entry), None if path is not a directory."""
+    try:
+        with os.scandir(path) as it:
+            return {entry.name for entry in it if entry.is_dir()}
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def _extract_member(zip_ref: zipfile.ZipFile, info: zipfile.ZipInfo, extract_to: Path) -> None:
+    """Extracts one zip entry; retries once if another thread created the same parent dir concurrently
+    (directories listed in the zip are created up front, this covers archives without directory entries)."""
+    try:
+        zip_ref.extract(info, extract_to)
+    except FileExistsError:
+        zip_ref.extract(info, extract_to)
+
+
+def unzip_and_find_model(zip_path: Path, extract_to: Path, zip_data: bytes | None = None) -> Path:
+    """
+    Unzips an archive and finds the 'vosk-model-*' directory.
+    If zip_data is given the archive is read from memory and zip_path is only used for naming.
+    """
     log.info(f"Extracting {zip_path} to {extract_to}")
     extracted_folder_name = None
+
+    def open_zip() -> zipfile.ZipFile:
+        # BytesIO trên bytes dùng chung bộ nhớ, không copy, mỗi thread có vị trí đọc riêng
+        if zip_data is not None:
+            return zipfile.ZipFile(io.BytesIO(zip_data), "r")
+        zip_file = zipfile.ZipFile(zip_path, "r")
+        if hasattr(os, "posix_fadvise"):
+            # Mỗi entry được đọc tuần tự từ đầu đến cuối: báo kernel tăng readahead cho fd này
+            os.posix_fadvise(zip_file.fp.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        return zip_file
+
     try:
-        with zipfile.ZipFile(zip_path, "r") as zip_ref:
-            vosk_dirs = [Path(f).name for f in zip_ref.namelist() if f.startswith("vosk-model-") and f.endswith('/')]
-            if not vosk_dirs:
-                all_members = zip_ref.namelist()
-                for member in all_members:
-                    parts = Path(member).parts
-                    if len(parts) > 1 and parts[0].startswith("vosk-model-") and parts[0] not in vosk_dirs:
-                        vosk_dirs.append(parts[0])
+        with open_zip() as zip_ref:
+            # Một lượt qua namelist, chỉ cắt chuỗi lấy thư mục gốc, đủ 2 thư mục gốc là biết có nhiều model
+            vosk_dirs = []
+            for name in zip_ref.namelist():
+                root, sep, _ = name.partition('/')
+                if sep and root.startswith("vosk-model-") and root not in vosk_dirs:
+                    vosk_dirs.append(root)
+                    if len(vosk_dirs) > 1:
+                        break
 
             if not vosk_dirs:
                 raise ModelExtractionError(f"No directory starting with 'vosk-model-' found in {zip_path.name}")
@@ -130,14 +698,41 @@ def unzip_and_find_model(zip_path: Path, extract_to: Path) -> Path:
             extracted_folder_name = vosk_dirs[0]
 
             log.info(f"Starting extraction of {zip_path.name}...")
-            zip_ref.extractall(extract_to)
+            # Tạo trước các thư mục (tuần tự) để các thread không tranh nhau makedirs
+            members = []
+            for info in zip_ref.infolist():
+                if info.is_dir():
+                    zip_ref.extract(info, extract_to)
+                else:
+                    members.append(info)
+            # zlib nhả GIL khi inflate nên giải nén song song từng entry, entry lớn làm trước cho đều tải.
+            # Mỗi thread mở ZipFile riêng để không phải tranh lock/seek trên cùng một file handle.
+            members.sort(key=lambda info: info.file_size, reverse=True)
+            worker_state = threading.local()
+            worker_zips = []
+
+            def open_worker_zip():
+                worker_state.zip_ref = open_zip()
+                worker_zips.append(worker_state.zip_ref)
+
+            def extract(info: zipfile.ZipInfo):
+                _extract_member(worker_state.zip_ref, info, extract_to)
+
+            try:
+                workers = max((os.cpu_count() or 1) // MAX_CONCURRENT_EXTRACTIONS, 1)
+                with ThreadPoolExecutor(max_workers=workers, initializer=open_worker_zip) as pool:
+                    for future in [pool.submit(extract, info) for info in members]:
+                        future.result()
+            finally:
+                for worker_zip in worker_zips:
+                    worker_zip.close()
             log.info(f"Finished extraction of {zip_path.name}.")
 
 
         extracted_path = extract_to / extracted_folder_name
         if not extracted_path.is_dir():
             potential_path = extract_to / zip_path.stem
-            if potential_path.is_dir() and any((potential_path / item).exists() for item in ["am", "conf", "graph", "ivector"]):
+            if {"am", "conf", "graph", "ivector"} & (_subdir_names(potential_path) or set()):
                 log.warning(f"Model content possibly extracted directly into {potential_path}, using it.")
                 extracted_path = potential_path
                 extracted_folder_name = potential_path.name
@@ -162,23 +757,40 @@ def unzip_and_find_model(zip_path: Path, extract_to: Path) -> Path:
 
 
 def rename_model_dir(source_path: Path, target_name: str, base_dir: Path) -> Path:
-    """Renames the extracted model directory."""
+    """
+    Renames the extracted model directory to target_name. An existing model at the target
+    is only moved aside right before the swap and deleted once the new one is in place,
+    so a failed update never leaves the user without a model.
+    """
     target_path = base_dir / target_name
+    old_path = base_dir / f".{target_name}.old"
     log.info(f"Renaming {source_path.name} -> {target_path.name}")
     try:
         target_path.parent.mkdir(exist_ok=True, parents=True)
-        if target_path.exists():
-            log.warning(f"Target path {target_path} exists unexpectedly before rename. Attempting to remove.")
-            try:
-                if target_path.is_dir():
-                    shutil.rmtree(target_path)
-                else:
-                    target_path.unlink()
-            except OSError as e:
-                log.error(f"Could not remove pre-existing target {target_path} before rename: {e}")
-                raise
-
-        shutil.move(str(source_path), str(target_path))
+        if old_path.is_dir():
+            shutil.rmtree(old_path) # Sót lại từ lần cập nhật trước bị ngắt giữa chừng
+
+        # fsync dữ liệu trước khi đổi tên và fsync thư mục cha sau đó, để mất điện không để lại model hỏng mà trông như đã tải xong
+        _fsync_tree(source_path)
+        moved_aside = False
+        if target_path.is_dir():
+            # os.replace không ghi đè được thư mục khác rỗng: dời bản cũ sang bên rồi mới đổi tên bản mới vào
+            os.replace(target_path, old_path)
+            moved_aside = True
+        elif target_path.exists():
+            target_path.unlink()
+        try:
+            if os.stat(source_path.parent).st_dev == os.stat(target_path.parent).st_dev:
+                os.replace(source_path, target_path) # Cùng filesystem: chỉ đổi tên, không copy dữ liệu
+            else:
+                shutil.move(str(source_path), str(target_path))
+        except OSError:
+            if moved_aside:
+                os.replace(old_path, target_path) # Trả lại model cũ
+            raise
+        _fsync_dir(target_path.parent)
+        if moved_aside:
+            shutil.rmtree(old_path, ignore_errors=True)
         log.info(f"Successfully renamed model to {target_path}")
         return target_path
     except OSError as e:
@@ -192,91 +804,163 @@ def rename_model_dir(source_path: Path, target_name: str, base_dir: Path) -> Pat
         raise
 
 
-async def process_model(session: aiohttp.ClientSession, language: str, url: str):
-    """Handles download, unzip, and rename for a single model, checking existence first."""
+async def process_model(session: aiohttp.ClientSession, language: str, url: str, download_sem: asyncio.Semaphore | None = None,
+                        extract_sem: asyncio.Semaphore | None = None) -> ModelResult:
+    """
+    Handles download, unzip, and rename for a single model, checking existence first.
+    download_sem bounds how many downloads run at once and extract_sem how many zips are
+    unzipped at once; each stage is gated separately and runs in a thread, so extraction
+    overlaps with the other downloads.
+    Returns a ModelResult with the final model directory, or the error if the model could not be processed.
+    """
     log.info(f"--- Processing model for language: {language} ---")
 
-    target_name = MODEL_TARGET_NAMES.get(language)
+    target_name = _model_target_names().get(language)
     if not target_name:
         log.error(f"No target name found in MODEL_MAPPER.json for language: {language}. Skipping.")
-        return
+        return ModelResult(language, "failed", error=ModelDownloadError(f"No target name in MODEL_MAPPER.json for {language}"))
 
     final_model_path = MODELS_DIR / target_name
+    archive_kind = _archive_kind(url)
+    # CRC central directory của file zip đã cài, so với bản trên server để biết model có đổi không
+    manifest_path = MODELS_DIR / f"{target_name}.manifest"
+    remote_crc = None
 
-    if final_model_path.is_dir():
-        is_valid = (final_model_path / "am").is_dir() and \
-                   (final_model_path / "conf").is_dir()
+    subdirs = _subdir_names(final_model_path)
+    if subdirs is not None:
+        is_valid = {"am", "conf"} <= subdirs
+
+        if is_valid and archive_kind == "zip" and manifest_path.is_file():
+            remote_crc = await _zip_eocd_crc(session, url)
+            if remote_crc is not None and manifest_path.read_text().strip() != f"{remote_crc:08x}":
+                log.info(f"Model '{target_name}' changed on the server (central directory differs from {manifest_path.name}).")
+                is_valid = False
 
         if is_valid:
             log.info(f"Model '{target_name}' already exists and seems valid. Skipping.")
-            return
-        else:
-            log.warning(f"Model directory '{target_name}' exists but looks incomplete or invalid. Removing and re-downloading.")
-            try:
-                shutil.rmtree(final_model_path)
-                log.info(f"Removed existing incomplete directory: {final_model_path}")
-            except OSError as e:
-                log.error(f"Could not remove existing incomplete model directory {final_model_path}: {e}. Skipping processing for {language}.")
-                return
+            return ModelResult(language, "skipped", final_model_path)
+        # Giữ thư mục cũ tới khi bản mới giải nén xong, rename_model_dir mới thay thế nó
+        log.warning(f"Model directory '{target_name}' exists but is outdated or incomplete. Re-downloading, it is replaced once the new copy is ready.")
 
     zip_filename = f"{target_name}.zip"
     zip_path = MODELS_DIR / zip_filename
+    zip_data = None
+    range_size = None
+    memory_reserved = 0
 
     try:
-        await download_file(session, url, zip_path)
-        extracted_path = unzip_and_find_model(zip_path, MODELS_DIR)
-        final_path = rename_model_dir(extracted_path, target_name, MODELS_DIR)
+        async with download_sem if download_sem is not None else nullcontext():
+            if archive_kind == "zip" and remote_crc is None:
+                remote_crc = await _zip_eocd_crc(session, url)
+            if archive_kind != "zip":
+                # tar đọc tuần tự được nên luôn giải nén ngay trong lúc tải
+                if archive_kind == "tar.zst" and zstandard is None:
+                    raise ModelDownloadError(f"{url} is a .tar.zst archive, install 'zstandard' to extract it")
+                extractor = partial(_extract_tar_stream, zstd=archive_kind == "tar.zst")
+                extracted_path = await download_and_extract_stream(session, url, MODELS_DIR, extractor)
+            elif stream_unzip is not None and (range_size := await _range_download_size(session, url)) is None:
+                # Server không hỗ trợ Range hoặc file nhỏ: giải nén ngay trong lúc tải, không ghi rồi đọc lại file zip
+                extracted_path = await download_and_extract_stream(session, url, MODELS_DIR)
+            else:
+                # File lớn có Range: tải nhiều kết nối (hoặc giữ trong RAM nếu đủ nhỏ và còn budget) rồi giải nén song song
+                memory_reserved = _reserve_memory(range_size)
+                zip_data = await download_file(session, url, zip_path, memory_reserved, range_size)
+                extracted_path = None
+        if extracted_path is None:
+            async with extract_sem if extract_sem is not None else nullcontext():
+                extracted_path = await asyncio.to_thread(unzip_and_find_model, zip_path, MODELS_DIR, zip_data)
+            zip_data = None
+        final_path = await asyncio.to_thread(rename_model_dir, extracted_path, target_name, MODELS_DIR)
         log.info(f"Successfully processed model for {language}. Final path: {final_path}")
+        if remote_crc is not None:
+            try:
+                manifest_path.write_text(f"{remote_crc:08x}")
+            except OSError as e:
+                log.warning(f"Could not write {manifest_path}: {e}")
+        return ModelResult(language, "ok", final_path)
 
     except (ModelDownloadError, ModelExtractionError, OSError, Exception) as e:
         log.error(f"Failed to process model for language '{language}': {e}")
+        return ModelResult(language, "failed", error=e)
 
     finally:
+        zip_data = None
+        _release_memory(memory_reserved)
         if zip_path.exists() and 'final_path' not in locals():
             log.debug(f"Cleaning up zip file {zip_path} after error during processing.")
-            safe_remove(zip_path)
+            await safe_remove_async(zip_path)
 
 
-async def download_all_models():
-    """Downloads and processes all models concurrently."""
-    if not MODELS_LINKS or not MODEL_TARGET_NAMES:
-        log.error("MODEL_LINKS or MODEL_TARGET_NAMES is empty. Check JSON files. Aborting.")
-        return
+async def download_all_models(on_ready: Callable[[ModelResult], None] | None = None) -> list[ModelResult]:
+    """
+    Downloads and processes all models concurrently and returns one ModelResult per model.
+    on_ready, if given, is called in the event loop with each model that is installed ("ok" or "skipped")
+    as soon as it finishes, while the other downloads are still running.
+    """
+    models_links = _models_links()
+    if not models_links or not _model_target_names():
+        log.error("MODELS.json or MODEL_MAPPER.json is empty. Check JSON files. Aborting.")
+        return []
 
-    num_models = len(MODELS_LINKS)
+    num_models = len(models_links)
     log.info(f"Found {num_models} models to potentially process.")
 
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for language, url in MODELS_LINKS.items():
-            task = asyncio.create_task(
-                process_model(session, language, url),
-                name=f"Task-{language}"
-            )
-            tasks.append(task)
+    download_sem = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    extract_sem = asyncio.Semaphore(MAX_CONCURRENT_EXTRACTIONS)
+
+    # Các model thường cùng một host: mỗi download có thể mở RANGE_DOWNLOAD_PARTS kết nối Range,
+    # cộng thêm chỗ cho các request HEAD/đuôi zip để chúng không phải xếp hàng sau các range
+    per_host = MAX_CONCURRENT_DOWNLOADS * (max(RANGE_DOWNLOAD_PARTS, 1) + 1)
+    # Một session cho mọi download: giữ kết nối keep-alive và cache DNS giữa các model cùng host
+    connector = aiohttp.TCPConnector(
+        limit=max(32, per_host),
+        limit_per_host=per_host,
+        ttl_dns_cache=600,
+        keepalive_timeout=75,
+        enable_cleanup_closed=True
+    )
+    # Không giới hạn tổng thời gian (model lớn tải lâu), chỉ báo lỗi khi server im lặng quá lâu
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=60)
+
+    async def process_and_notify(session: aiohttp.ClientSession, language: str, url: str) -> ModelResult:
+        result = await process_model(session, language, url, download_sem, extract_sem)
+        if on_ready is not None and result.status != "failed":
+            try:
+                on_ready(result)
+            except Exception as e:
+                log.error(f"on_ready callback failed for {language}: {e}")
+        return result
 
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        results = await asyncio.gather(
+            *(process_and_notify(session, language, url) for language, url in models_links.items()),
+            return_exceptions=True
+        )
 
     log.info("--- Download Process Summary ---")
-    success_count = 0
-    fail_count = 0
-
-    for i, result in enumerate(results):
-        task_name = tasks[i].get_name()
-        if isinstance(result, Exception):
-            fail_count += 1
-        elif result is None:
-            success_count +=1
-
-    log.info(f"Summary: {success_count} completed/skipped, {fail_count} failed.")
+    # process_model tự bắt lỗi, exception ở đây chỉ còn từ lỗi ngoài dự kiến
+    results = [
+        ModelResult(language, "failed", error=result) if isinstance(result, BaseException) else result
+        for language, result in zip(models_links, results)
+    ]
+    counts = Counter(result.status for result in results)
+    log.info(f"Summary: {counts['ok']} downloaded, {counts['skipped']} skipped, {counts['failed']} failed.")
+    failed = [result.language for result in results if result.status == "failed"]
+    if failed:
+        log.warning(f"Failed models (re-run to retry only these): {', '.join(failed)}")
+    return results
 
 
 if __name__ == '__main__':
+    setup_logger()
     log.info("Starting model download process...")
     if not Path("MODELS.json").exists() or not Path("MODEL_MAPPER.json").exists():
         log.error("MODELS.json or MODEL_MAPPER.json not found. Please create them.")
     else:
-        asyncio.run(download_all_models())
+        if uvloop is not None:
+            uvloop.run(download_all_models())
+        else:
+            asyncio.run(download_all_models())
     log.info("Model download process finished.")
 
 """
@@ -0,0 +1,85 @@
+import json
+import sys
+import types
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+
+class FakeModel:
+    def __init__(self, model_path=None):
+        self.model_path = model_path
+
+
+def vosk_json(**fields) -> bytes:
+    """JSON đúng định dạng Vosk in ra, vd b'{\\n  "partial" : ""\\n}'."""
+    return json.dumps(fields, indent=2, separators=(",", " : ")).encode()
+
+
+class FakeKaldiRecognizer:
+    """
+    Thay cho KaldiRecognizer thật (cần libvosk): giữ đúng ràng buộc kiểu của binding cffi
+    (char *, chỉ nhận bytes) và trả JSON cùng schema với Vosk.
+    """
+    def __init__(self, model, sample_rate):
+        self.received = 0
+
+    @staticmethod
+    def _check(data):
+        if not isinstance(data, bytes):
+            raise TypeError(f"initializer for ctype 'char *' must be a bytes, not {type(data).__name__}")
+
+    def SetWords(self, enable):
+        pass
+
+    def Reset(self):
+        self.received = 0
+
+    def AcceptWaveform(self, data):
+        self._check(data)
+        self.received += len(data)
+        return 0
+
+    def AcceptWaveformBytes(self, data):
+        """
+        b"END..." giả lập Vosk chốt câu (trả kết quả cuối rồi bắt đầu câu mới), frame toàn 0 là im lặng
+        (partial rỗng), còn lại trả partial với tổng số byte của câu hiện tại.
+        """
+        self._check(data)
+        if data.startswith(b"END"):
+            return True, self.FinalResultBytes()
+        if not data.strip(b"\0"):
+            return False, vosk_json(partial="")
+        self.received += len(data)
+        return False, vosk_json(partial=f"{self.received} bytes")
+
+    def FinalResult(self):
+        # Như Vosk: lấy kết quả cuối xong thì recognizer bắt đầu câu mới
+        received, self.received = self.received, 0
+        return vosk_json(text=f"{received} bytes" if received else "").decode()
+
+    def FinalResultBytes(self):
+        return self.FinalResult().encode()
+
+
+fake_vosk = types.ModuleType("vosk")
+fake_vosk.Model = FakeModel
+fake_vosk.KaldiRecognizer = FakeKaldiRecognizer
+fake_vosk.SetLogLevel = lambda level: None
+sys.modules["vosk"] = fake_vosk
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """TestClient cho main.app với một ngôn ngữ giả "en", không chạy lifespan (không quét/tải model)."""
+    from fastapi.testclient import TestClient
+    import main
+
+    monkeypatch.setattr(main, "available_languages", frozenset({"en"}))
+    monkeypatch.setattr(main.model_loader, "get_model", lambda lang_code: FakeModel())
+    main.RECOGNIZER_POOL.clear()
+    return TestClient(main.app)
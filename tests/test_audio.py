@@ -0,0 +1,51 @@
+import io
+import math
+import struct
+import wave
+
+import pytest
+
+import main
+
+
+def make_wav(sample_rate: int, channels: int = 1, seconds: float = 1.0) -> bytes:
+    frames = int(sample_rate * seconds)
+    samples = [int(8000 * math.sin(2 * math.pi * 440 * i / sample_rate)) for i in range(frames)]
+    pcm = struct.pack(f"<{frames * channels}h", *(s for s in samples for _ in range(channels)))
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm)
+    return buf.getvalue()
+
+
+def test_wav_16k_mono_skips_decoding():
+    wav_bytes = make_wav(16000)
+    pcm = main.convert_audio_for_vosk(io.BytesIO(wav_bytes))
+    assert pcm == wav_bytes[44:]
+
+
+@pytest.mark.parametrize("sample_rate,channels", [(8000, 1), (44100, 2)])
+def test_wav_resampled_to_16k_mono(sample_rate, channels):
+    if main.av is None:
+        pytest.skip("PyAV is not installed")
+    pcm = main.convert_audio_for_vosk(io.BytesIO(make_wav(sample_rate, channels)))
+    assert pcm is not None
+    # 1 giây 16kHz mono S16LE = 32000 bytes, cho phép lệch vài mẫu do resampler
+    assert abs(len(pcm) - 32000) <= 2 * 64
+    assert len(pcm) % 2 == 0
+
+
+def test_invalid_audio_returns_none():
+    if main.av is None:
+        pytest.skip("PyAV is not installed")
+    assert main.convert_audio_for_vosk(io.BytesIO(b"definitely not audio")) is None
+
+
+def test_wav_other_format_rewinds_for_decoder():
+    # WAV 8kHz không dùng được nguyên văn: file phải được đưa về đầu cho decoder đọc lại
+    audio_file = io.BytesIO(make_wav(8000))
+    assert main._pcm_from_wav(audio_file, 16000, 1) is None
+    assert audio_file.tell() == 0
@@ -0,0 +1,46 @@
+def test_raw_pcm_upload(client):
+    pcm = b"\x01\x00" * 16000 # 1 giây PCM S16LE 16kHz mono
+    response = client.post("/stt/en", params={"raw": "true"}, files={"file": ("audio.pcm", pcm, "application/octet-stream")})
+    assert response.status_code == 200
+    assert response.json() == {"text": f"{len(pcm)} bytes"}
+
+
+def test_l16_content_type_upload(client):
+    pcm = b"\x01\x00" * 8000
+    response = client.post("/stt/en", files={"file": ("audio.raw", pcm, "audio/l16; rate=16000; channels=1")})
+    assert response.status_code == 200
+    assert response.json() == {"text": f"{len(pcm)} bytes"}
+
+
+def test_raw_pcm_odd_length_rejected(client):
+    response = client.post("/stt/en", params={"raw": "true"}, files={"file": ("audio.pcm", b"\x01\x00\x02", "application/octet-stream")})
+    assert response.status_code == 400
+
+
+def test_oversize_upload_rejected(client, monkeypatch):
+    import main
+    monkeypatch.setattr(main, "MAX_UPLOAD_SIZE_BYTES", 1000)
+    response = client.post("/stt/en", files={"file": ("audio.wav", b"\0" * 2000, "audio/wav")})
+    assert response.status_code == 413
+
+
+def test_oversize_upload_rejected_from_content_length(client, monkeypatch):
+    # Body vượt cả phần dư multipart: bị chặn ngay từ Content-Length
+    import main
+    monkeypatch.setattr(main, "MAX_UPLOAD_SIZE_BYTES", 1000)
+    body = b"\0" * (main.MULTIPART_OVERHEAD_BYTES + 2000)
+    response = client.post("/stt/en", files={"file": ("audio.wav", body, "audio/wav")})
+    assert response.status_code == 413
+
+
+def test_unsupported_language(client):
+    response = client.post("/stt/xx", files={"file": ("audio.pcm", b"\1\0", "audio/l16")})
+    assert response.status_code == 400
+
+
+def test_wav_upload_decoded_from_spooled_file(client):
+    from tests.test_audio import make_wav
+    wav_bytes = make_wav(16000)
+    response = client.post("/stt/en", files={"file": ("audio.wav", wav_bytes, "audio/wav")})
+    assert response.status_code == 200
+    assert response.json() == {"text": f"{len(wav_bytes) - 44} bytes"}
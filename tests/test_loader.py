@@ -0,0 +1,46 @@
+import asyncio
+
+import model_downloader as md
+from core import loader
+
+
+def test_downloaded_model_loads_while_others_download(tmp_path, monkeypatch):
+    monkeypatch.setattr(loader, "MODELS_BASE_DIR", str(tmp_path))
+    monkeypatch.setattr(loader, "load_language_folder_map", lambda: {"English": "en", "Japanese": "ja"})
+    model_loader = loader.ModelLoader()
+    loaded_while_downloading = []
+
+    async def fake_download_all_models(on_ready=None):
+        path = tmp_path / "English"
+        (path / "am").mkdir(parents=True)
+        on_ready(md.ModelResult("en", "ok", path))
+        # "ja" vẫn đang tải: model "en" phải được load xong trong lúc này
+        for _ in range(200):
+            if "en" in model_loader.models:
+                break
+            await asyncio.sleep(0.01)
+        loaded_while_downloading.append("en" in model_loader.models)
+        return []
+
+    monkeypatch.setattr(loader, "download_all_models", fake_download_all_models)
+    languages = asyncio.run(model_loader.scan_models(lambda lang_code: True))
+    assert languages == ["en"]
+    assert loaded_while_downloading == [True]
+    assert model_loader.models["en"].model_path == str(tmp_path / "English")
+
+
+def test_prefetch_without_stamp_does_not_fail(tmp_path):
+    # Không có am/ nên không tính được stamp: vẫn prefetch, không ghi file stamp, không lỗi
+    (tmp_path / "model.conf").write_bytes(b"x" * 10000)
+    loader._prefetch_model_files(str(tmp_path))
+    assert not (tmp_path / loader.WARM_STAMP_FILE).exists()
+
+
+def test_prefetch_writes_stamp_and_skips_next_time(tmp_path, monkeypatch):
+    (tmp_path / "am").mkdir()
+    (tmp_path / "am" / "final.mdl").write_bytes(b"x" * 10000)
+    loader._prefetch_model_files(str(tmp_path))
+    assert (tmp_path / loader.WARM_STAMP_FILE).read_text() == loader._warm_stamp(str(tmp_path))
+
+    monkeypatch.setattr(loader.os, "walk", lambda path: (_ for _ in ()).throw(AssertionError("prefetched again")))
+    loader._prefetch_model_files(str(tmp_path))
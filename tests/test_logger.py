@@ -0,0 +1,21 @@
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+
+
+def test_import_has_no_side_effects(tmp_path):
+    env = {**os.environ, "PYTHONPATH": str(ROOT)}
+    env.pop("AUTO_LOG_CONFIG", None)
+    code = "import logging, core.logger; assert not logging.getLogger().handlers"
+    subprocess.run([sys.executable, "-c", code], cwd=tmp_path, env=env, check=True)
+    assert not (tmp_path / ".logs").exists()
+
+
+def test_setup_logger_configures_once(tmp_path):
+    env = {**os.environ, "PYTHONPATH": str(ROOT)}
+    code = ("import logging, core.logger as l; l.setup_logger(); l.setup_logger(); "
+            "assert len(logging.getLogger().handlers) == 2")
+    subprocess.run([sys.executable, "-c", code], cwd=tmp_path, env=env, check=True)
+    assert (tmp_path / ".logs" / "client.log").is_file()
@@ -0,0 +1,259 @@
+import asyncio
+import io
+import tarfile
+import zipfile
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+import model_downloader as md
+
+
+def make_zip(extra: dict | None = None) -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("vosk-model-test/am/final.mdl", b"model" * 50000)
+        zf.writestr("vosk-model-test/conf/model.conf", b"--sample-frequency=16000\n")
+        for name, data in (extra or {}).items():
+            zf.writestr(f"vosk-model-test/{name}", data)
+    return buf.getvalue()
+
+
+def make_tar(kind: str) -> bytes:
+    """Model dạng tar nén gzip hoặc zstd, có một member chỉ đọc (0o444) như trong các bản phát hành."""
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz" if kind == "tar.gz" else "w") as tar:
+        for name, data, mode in [("am/final.mdl", b"model" * 50000, 0o444), ("conf/model.conf", b"--sample-frequency=16000\n", 0o644)]:
+            info = tarfile.TarInfo(f"vosk-model-test/{name}")
+            info.size = len(data)
+            info.mode = mode
+            tar.addfile(info, io.BytesIO(data))
+    if kind == "tar.zst":
+        return md.zstandard.ZstdCompressor().compress(buf.getvalue())
+    return buf.getvalue()
+
+
+class ZipServer:
+    """Server HTTP cục bộ phục vụ một file zip (hoặc tar), có thể đổi nội dung hoặc cắt ngang giữa chừng."""
+
+    def __init__(self, data: bytes, supports_range: bool = True, name: str = "model.zip"):
+        self.data = data
+        self.supports_range = supports_range
+        self.name = name
+        self.truncate = False
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        data = self.data
+        range_header = request.headers.get("Range")
+        if self.supports_range and range_header:
+            spec = range_header.removeprefix("bytes=")
+            start, _, end = spec.partition("-")
+            if not start: # bytes=-N: N byte cuối (đọc central directory), luôn trả đủ
+                start, end = max(len(data) - int(end), 0), len(data) - 1
+            elif self.truncate:
+                return await self.send_truncated(request, data[int(start):int(end) + 1], status=206)
+            else:
+                start, end = int(start), int(end) if end else len(data) - 1
+            return web.Response(status=206, body=data[start:end + 1], headers={
+                "Content-Range": f"bytes {start}-{end}/{len(data)}",
+            })
+        headers = {"Content-Length": str(len(data))}
+        if self.supports_range:
+            headers["Accept-Ranges"] = "bytes"
+        if request.method == "HEAD":
+            return web.Response(headers=headers)
+        if self.truncate:
+            return await self.send_truncated(request, data, headers=headers)
+        response = web.StreamResponse(headers=headers)
+        await response.prepare(request)
+        await response.write(data)
+        return response
+
+    @staticmethod
+    async def send_truncated(request: web.Request, data: bytes, status: int = 200, headers: dict | None = None) -> web.StreamResponse:
+        # Báo đủ Content-Length nhưng chỉ gửi một nửa rồi mất kết nối
+        response = web.StreamResponse(status=status, headers={**(headers or {}), "Content-Length": str(len(data))})
+        await response.prepare(request)
+        await response.write(data[:len(data) // 2])
+        request.transport.close()
+        return response
+
+    async def __aenter__(self) -> str:
+        app = web.Application()
+        app.router.add_route("*", f"/{self.name}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        return f"http://{host}:{port}/{self.name}"
+
+    async def __aexit__(self, *exc):
+        await self.runner.cleanup()
+
+
+@pytest.fixture
+def models_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(md, "MODELS_DIR", tmp_path)
+    monkeypatch.setattr(md, "_model_target_names", lambda: {"en": "English"})
+    return tmp_path
+
+
+async def process(url: str) -> md.ModelResult:
+    async with aiohttp.ClientSession() as session:
+        return await md.process_model(session, "en", url)
+
+
+def leftovers(models_dir):
+    return sorted(p.name for p in models_dir.iterdir() if p.name not in ("English", "English.manifest"))
+
+
+@pytest.fixture(params=["stream", "memory", "disk", "ranges"])
+def download_path(request, monkeypatch):
+    """Chạy cùng một test qua từng cách tải: stream-unzip, giữ trong RAM, ghi ra đĩa, nhiều kết nối Range."""
+    if request.param == "stream":
+        if md.stream_unzip is None:
+            pytest.skip("stream-unzip is not installed")
+        monkeypatch.setattr(md, "RANGE_MIN_SIZE", 1 << 40) # Không bao giờ dùng Range
+    else:
+        monkeypatch.setattr(md, "RANGE_MIN_SIZE", 1)
+        monkeypatch.setattr(md, "MEMORY_DOWNLOAD_LIMIT", 1 << 30 if request.param == "memory" else 0)
+        monkeypatch.setattr(md, "MEMORY_DOWNLOAD_BUDGET", 1 << 30)
+        if request.param == "disk":
+            monkeypatch.setattr(md, "RANGE_DOWNLOAD_PARTS", 1)
+    return request.param
+
+
+def test_download_and_install(models_dir, download_path):
+    async def run():
+        async with ZipServer(make_zip()) as url:
+            return await process(url)
+
+    result = asyncio.run(run())
+    assert result.status == "ok"
+    assert (models_dir / "English" / "am" / "final.mdl").read_bytes() == b"model" * 50000
+    assert leftovers(models_dir) == []
+
+
+def test_memory_budget_is_shared_and_released(monkeypatch):
+    monkeypatch.setattr(md, "MEMORY_DOWNLOAD_LIMIT", 64)
+    monkeypatch.setattr(md, "MEMORY_DOWNLOAD_BUDGET", 100)
+    first = md._reserve_memory(60)
+    assert first == 60
+    assert md._reserve_memory(60) == 0 # Vượt budget chung: ghi ra đĩa
+    assert md._reserve_memory(80) == 0 # Vượt giới hạn mỗi file
+    md._release_memory(first)
+    assert md._reserve_memory(60) == 60
+    md._release_memory(60)
+    assert md._memory_in_use == 0
+
+
+def test_truncated_download_is_cleaned_up(models_dir, download_path):
+    async def run():
+        server = ZipServer(make_zip())
+        server.truncate = True
+        async with server as url:
+            return await process(url)
+
+    result = asyncio.run(run())
+    assert result.status == "failed"
+    assert not (models_dir / "English").exists()
+    # Không còn thư mục giải nén dở, file .zip hay .part
+    assert leftovers(models_dir) == []
+    assert md._memory_in_use == 0
+
+
+def test_manifest_skip_and_redownload(models_dir):
+    async def run():
+        server = ZipServer(make_zip())
+        async with server as url:
+            first = await process(url)
+            manifest = (models_dir / "English.manifest").read_text()
+            second = await process(url)
+            server.data = make_zip({"README": b"updated"})
+            third = await process(url)
+        return first, manifest, second, third
+
+    first, manifest, second, third = asyncio.run(run())
+    assert first.status == "ok"
+    assert second.status == "skipped"
+    assert third.status == "ok"
+    assert (models_dir / "English" / "README").read_bytes() == b"updated"
+    assert (models_dir / "English.manifest").read_text() != manifest
+    assert leftovers(models_dir) == []
+
+
+def test_failed_update_keeps_installed_model(models_dir):
+    async def run():
+        server = ZipServer(make_zip())
+        async with server as url:
+            await process(url)
+            manifest = (models_dir / "English.manifest").read_text()
+            # Bản mới trên server (central directory khác) nhưng tải bị đứt giữa chừng
+            server.data = make_zip({"README": b"updated"})
+            server.truncate = True
+            result = await process(url)
+        return manifest, result
+
+    manifest, result = asyncio.run(run())
+    assert result.status == "failed"
+    assert (models_dir / "English" / "am" / "final.mdl").is_file()
+    assert not (models_dir / "English" / "README").exists()
+    assert (models_dir / "English.manifest").read_text() == manifest
+    assert leftovers(models_dir) == []
+
+
+def test_server_without_range_skips_manifest(models_dir):
+    async def run():
+        async with ZipServer(make_zip(), supports_range=False) as url:
+            return await process(url)
+
+    result = asyncio.run(run())
+    assert result.status == "ok"
+    assert not (models_dir / "English.manifest").exists()
+
+
+def test_on_ready_reports_each_installed_model(models_dir, monkeypatch):
+    ready = []
+
+    async def run():
+        async with ZipServer(make_zip()) as url:
+            # "xx" không có trong MODEL_MAPPER.json nên thất bại, không được báo
+            monkeypatch.setattr(md, "_models_links", lambda: {"en": url, "xx": url})
+            return await md.download_all_models(ready.append)
+
+    results = asyncio.run(run())
+    assert {result.language: result.status for result in results} == {"en": "ok", "xx": "failed"}
+    assert [(result.language, result.path) for result in ready] == [("en", models_dir / "English")]
+
+
+def test_fsync_tree_handles_read_only_files(tmp_path):
+    (tmp_path / "am").mkdir()
+    read_only = tmp_path / "am" / "final.mdl"
+    read_only.write_bytes(b"model")
+    read_only.chmod(0o444)
+    md._fsync_tree(tmp_path)
+
+
+@pytest.mark.parametrize("kind", ["tar.gz", "tar.zst"])
+@pytest.mark.parametrize("truncate", [False, True])
+def test_streamed_tar_install(models_dir, kind, truncate):
+    if kind == "tar.zst" and md.zstandard is None:
+        pytest.skip("zstandard is not installed")
+
+    async def run():
+        server = ZipServer(make_tar(kind), name=f"model.{kind}")
+        server.truncate = truncate
+        async with server as url:
+            return await process(url)
+
+    result = asyncio.run(run())
+    if truncate:
+        assert result.status == "failed"
+        assert not (models_dir / "English").exists()
+    else:
+        assert result.status == "ok"
+        assert (models_dir / "English" / "am" / "final.mdl").read_bytes() == b"model" * 50000
+    # tar không có central directory nên không ghi manifest; không còn thư mục giải nén dở
+    assert sorted(p.name for p in models_dir.iterdir()) == ([] if truncate else ["English"])
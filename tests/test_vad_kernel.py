@@ -0,0 +1,55 @@
+import sys
+
+import numpy as np
+import pytest
+
+from conftest import ROOT
+
+# Import giống các client (chạy từ thư mục Clients), cache của Numba gắn với tên module "vad_kernel"
+sys.path.insert(0, str(ROOT / "Clients"))
+import vad_kernel # noqa: E402
+
+FRAME_SAMPLES = 480 # 30 ms ở 16kHz
+
+
+def make_block(seed: int = 0) -> np.ndarray:
+    """Block float32 gồm frame im lặng, frame có tiếng (ZCR thấp và cao) và vài giá trị NaN/Inf/vượt [-1, 1]."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(FRAME_SAMPLES, dtype=np.float32) / 16000
+    frames = [
+        np.zeros(FRAME_SAMPLES, dtype=np.float32),
+        (rng.standard_normal(FRAME_SAMPLES) * 1e-4).astype(np.float32),
+        (0.5 * np.sin(2 * np.pi * 220 * t)).astype(np.float32),
+        (0.3 * rng.standard_normal(FRAME_SAMPLES)).astype(np.float32),
+        (1.5 * np.sin(2 * np.pi * 440 * t)).astype(np.float32),
+    ]
+    block = np.concatenate(frames + [np.full(100, 0.2, dtype=np.float32)]) # Đuôi không đủ một frame
+    block[[10, 1000, 1500]] = [np.nan, np.inf, -np.inf]
+    return block
+
+
+def test_numpy_fallback_gates():
+    block = make_block()
+    out = np.empty(block.shape[0], dtype=np.int16)
+    gate = vad_kernel._convert_and_gate_py(block, out, FRAME_SAMPLES, vad_kernel.ENERGY_THRESHOLD_DB,
+                                           vad_kernel.ENERGY_MARGIN_DB, vad_kernel.ZCR_MAX)
+    assert gate.tolist() == [vad_kernel.GATE_SILENCE, vad_kernel.GATE_SILENCE, vad_kernel.GATE_SPEECH,
+                             vad_kernel.GATE_UNSURE, vad_kernel.GATE_SPEECH]
+    assert out[10] == 0 and out[1000] == 32767 and out[1500] == -32767
+
+
+def test_jit_matches_numpy_fallback():
+    if vad_kernel.njit is None:
+        pytest.skip("numba is not installed")
+    args = (FRAME_SAMPLES, vad_kernel.ENERGY_THRESHOLD_DB, vad_kernel.ENERGY_MARGIN_DB, vad_kernel.ZCR_MAX)
+    for seed in range(5):
+        block = make_block(seed)
+        out_py = np.empty(block.shape[0], dtype=np.int16)
+        out_jit = np.empty(block.shape[0], dtype=np.int16)
+        gate_py = vad_kernel._convert_and_gate_py(block, out_py, *args)
+        gate_jit = vad_kernel._convert_and_gate_jit(block, out_jit, *args)
+        np.testing.assert_array_equal(gate_jit, gate_py)
+        # Bản JIT nhân 32767 ở float64, bản NumPy ở float32: làm tròn có thể lệch 1 LSB
+        assert np.abs(out_jit.astype(np.int32) - out_py).max() <= 1
+
+        np.testing.assert_array_equal(vad_kernel._gate_int16_jit(out_py, *args), vad_kernel._gate_int16_py(out_py, *args))
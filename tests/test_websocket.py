@@ -0,0 +1,81 @@
+import asyncio
+import json
+
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+import main
+
+SPEECH = b"\x01\x00" * 100 # 200 byte audio bất kỳ khác 0
+SILENCE = b"\x00" * 200
+
+
+def test_model_load_failure_closes_after_accept(client, monkeypatch):
+    monkeypatch.setattr(main.model_loader, "get_model", lambda lang_code: None)
+    # Handshake vẫn thành công, lỗi load model được báo bằng close 1011
+    with client.websocket_connect("/ws/stt/en") as websocket:
+        with pytest.raises(WebSocketDisconnect) as exc_info:
+            websocket.receive_bytes()
+    assert exc_info.value.code == 1011
+
+
+def test_unsupported_language_closed_with_policy_violation(client):
+    with pytest.raises(WebSocketDisconnect) as exc_info:
+        with client.websocket_connect("/ws/stt/xx") as websocket:
+            websocket.receive_bytes()
+    assert exc_info.value.code == 1008
+
+
+def test_results_forwarded_verbatim_as_binary(client):
+    with client.websocket_connect("/ws/stt/en") as websocket:
+        websocket.send_bytes(SPEECH)
+        # JSON của Vosk được gửi nguyên văn bằng send_bytes, không parse/dựng lại
+        assert websocket.receive_bytes() == b'{\n  "partial" : "200 bytes"\n}'
+        websocket.send_bytes(SILENCE) # Partial rỗng: không gửi
+        websocket.send_bytes(b"END")
+        assert json.loads(websocket.receive_bytes()) == {"text": "200 bytes"}
+
+
+def test_silence_flushes_final_result(client):
+    with client.websocket_connect("/ws/stt/en") as websocket:
+        websocket.send_bytes(SPEECH)
+        assert json.loads(websocket.receive_bytes()) == {"partial": "200 bytes"}
+        # Client im lặng quá RECEIVE_TIMEOUT: timer chốt câu và gửi kết quả cuối, không cần frame mới
+        assert json.loads(websocket.receive_bytes()) == {"text": "200 bytes"}
+        websocket.send_bytes(SPEECH)
+        assert json.loads(websocket.receive_bytes()) == {"partial": "200 bytes"} # Câu mới bắt đầu lại từ 0
+
+
+def test_writer_sends_finals_and_only_latest_partial():
+    class RecordingWebSocket:
+        def __init__(self):
+            self.sent = []
+
+        async def send_bytes(self, data):
+            self.sent.append(data)
+
+    async def run():
+        websocket = RecordingWebSocket()
+        out_queue = asyncio.Queue()
+        # Đã xếp hàng sẵn trước khi writer chạy: partial bị message sau thay thế thì bỏ, final luôn gửi
+        for item in [(False, b"p1"), (False, b"p2"), (True, b"f1"), (False, b"p3")]:
+            out_queue.put_nowait(item)
+        writer = asyncio.create_task(main.websocket_writer(websocket, out_queue))
+        await asyncio.sleep(0.01)
+        writer.cancel()
+        return websocket.sent
+
+    assert asyncio.run(run()) == [b"f1", b"p3"]
+
+
+def test_connection_stops_when_writer_dies(client, monkeypatch):
+    async def dead_writer(websocket, out_queue):
+        return # Giống writer dừng vì send lỗi
+
+    monkeypatch.setattr(main, "websocket_writer", dead_writer)
+    with client.websocket_connect("/ws/stt/en") as websocket:
+        websocket.send_bytes(SPEECH)
+        # Server ngừng nhận thay vì xếp kết quả vào queue không còn ai đọc
+        with pytest.raises(WebSocketDisconnect) as exc_info:
+            websocket.receive_bytes()
+    assert exc_info.value.code == 1011
@@ -193,6 +193,19 @@ class KaldiRecognizer:
     def FinalResult(self):
         return _ffi.string(_c.vosk_recognizer_final_result(self._handle)).decode("utf-8")
 
+    def AcceptWaveformBytes(self, data):
+        # AcceptWaveform followed by Result() or PartialResult() in one call. Returns
+        # (is_final, raw UTF-8 JSON bytes) so callers forwarding the JSON skip decode/encode.
+        res = _c.vosk_recognizer_accept_waveform(self._handle, data, len(data))
+        if res < 0:
+            raise Exception("Failed to process waveform")
+        if res:
+            return True, _ffi.string(_c.vosk_recognizer_result(self._handle))
+        return False, _ffi.string(_c.vosk_recognizer_partial_result(self._handle))
+
+    def FinalResultBytes(self):
+        return _ffi.string(_c.vosk_recognizer_final_result(self._handle))
+
     def Reset(self):
         return _c.vosk_recognizer_reset(self._handle)
 
@@ -224,7 +237,7 @@ class KaldiRecognizer:
         return srt.compose(subs)
 
 def SetLogLevel(level):
-    return None
+    return _c.vosk_set_log_level(level)
 
 
 def GpuInit():